@@ -1,15 +1,22 @@
 import csv
 import dataclasses
 import math
-import pathlib
+import multiprocessing
+import queue
+import sys
 import time
+import traceback
 import numpy as np
-from typing import Optional, Tuple, Dict, List, Callable, Any
+from typing import Optional, Tuple, Dict, List, Callable, Any, Set, Iterable
 
 import stim
 
-from decoding import sample_decode_count_correct
+from decoder_registry import get_decoder
+from decoding import sample_decode_count_shots_correct_per_decoder, DecodingArtifacts, decode_count_correct
+from parallel_decoding import DecodingPool
 from probability_util import log_binomial, binary_search
+from record_writer import RecordWriter
+from syndrome_archive import SyndromeArchive
 
 CSV_HEADER = ",".join([
     "data_width",
@@ -27,6 +34,7 @@ CSV_HEADER = ",".join([
     "version",
 ])
 CSV_HEADER_VERSION = 2
+SHARD_LOG_HEADER = CSV_HEADER + ",seed"
 
 
 @dataclasses.dataclass(frozen=True, unsafe_hash=True, order=True)
@@ -101,7 +109,20 @@ def collect_simulated_experiment_data(problems: List[DecodingProblem],
                                       max_sample_std_dev: float = 1,
                                       min_seen_logical_errors: int,
                                       out_path: Optional[str],
-                                      discard_previous_data: bool):
+                                      discard_previous_data: bool,
+                                      num_workers: int = 1,
+                                      shard_log_path: Optional[str] = None,
+                                      time_budget_seconds: Optional[float] = None,
+                                      target_batch_seconds: Optional[float] = None,
+                                      max_batch_bytes: Optional[int] = None,
+                                      early_stop_chunk_size: Optional[int] = None,
+                                      share_samples: bool = False,
+                                      archive_dir: Optional[str] = None,
+                                      persistent_internal_decoder: bool = False,
+                                      lookup_table_dir: Optional[str] = None,
+                                      decoding_window: Optional[Tuple[float, float]] = None,
+                                      decoding_processes: int = 1,
+                                      sample_decode_kwargs: Optional[Dict[str, Any]] = None):
     """
     Args:
         problems: The decoding problems to collect sample data from.
@@ -134,100 +155,830 @@ def collect_simulated_experiment_data(problems: List[DecodingProblem],
         max_batch: Defaults to unused. If set, then at most this many shots are collected at one
             time.
         discard_previous_data: If set, `out_path` is overwritten. If not set, `out_path` will be
-            appended to (or created if needed).
+            appended to (or created if needed), and the data already recorded in it is credited
+            towards each problem's stopping rule. Problems that were already finished are skipped,
+            and the others continue from where they stopped.
+        num_workers: Defaults to 1. When larger than 1, this many worker processes sample and decode
+            batches in parallel, and a separate writer process appends the results to `out_path`.
+
+            Once every problem has been started, idle workers help finish the remaining problems by
+            splitting their batches into independently seeded shards.
+        shard_log_path: Defaults to unused. If set (and `num_workers` is larger than 1), every
+            sharded batch also appends one row per shard to this file. The rows use the CSV_HEADER
+            columns with an extra `seed` column, so a shard can be re-run exactly by passing the
+            seed and shot count to `sample_decode_count_correct`. This also holds for shards that
+            were stopped early (see `early_stop_chunk_size`), because the shots of a seeded sampler
+            don't depend on how they're split into chunks.
+        time_budget_seconds: Defaults to unlimited. If set, problems are no longer worked through
+            one at a time in order. Instead every problem gets one batch to estimate its cost, and
+            then the problem estimated to be cheapest to finish gets the next batch. Problems that
+            are estimated to not be finishable within the remaining wall clock time are abandoned,
+            and collection stops once the budget is used up. See `ProblemScheduler`.
+        target_batch_seconds: Defaults to unused (batch sizes double from `min_shots` up to
+            `max_batch`). If set, each batch after the first is sized to take about this many
+            processing seconds, based on the measured time per shot. Batches are also cut short
+            where the error rate seen so far predicts `min_seen_logical_errors` will be reached.
+        max_batch_bytes: Defaults to unlimited. If set, batches are kept small enough that their
+            bit packed detection event and observable data fits in this many bytes. Each decoder's
+            prediction cache is also limited to half this many bytes (see `PredictionCache`).
+        early_stop_chunk_size: Defaults to unused. If set, batches are processed in chunks of this
+            many shots and the stopping rule is checked after every chunk. Once it is met, the rest
+            of the batch is skipped and only the processed shots are recorded. When a batch is split
+            into shards, each shard extrapolates its own results to the whole batch when checking.
+        share_samples: Defaults to False. If set, problems that only differ by their decoder are
+            grouped together and sampled as one. Each batch is sampled once and decoded by every
+            decoder in the group, and one CSV row is written per decoder (with the batch's
+            processing time divided evenly between them). Besides halving the sampling work when
+            using two decoders, this makes the decoders' results paired comparisons. A group keeps
+            being sampled until the stopping rule is met for the decoder making the fewest mistakes.
+            Problems are assumed to have the same circuit when their descriptions only differ by
+            decoder.
+        archive_dir: Defaults to unused. If set, every sampled shot is also saved (bit packed) into
+            a `SyndromeArchive` in this directory, with one archive per problem (ignoring the
+            decoder, since the samples don't depend on it). The saved shots can be decoded again
+            later, e.g. by a new decoder, using `decode_archive`.
+        persistent_internal_decoder: Defaults to False. If set, the internal decoder is started once
+            per problem (and per worker) and fed each batch through its stdin and stdout, instead of
+            being started (and re-reading the error model) for every batch. See `DecoderWorker`.
+            Requires a build of the internal decoder that streams its input and output; with other
+            builds, the first batch times out and the problem falls back to one start per batch.
+        lookup_table_dir: Defaults to a directory in the system's temporary directory. Where the
+            tables of the "lookup" decoder are saved, so that each is only built once per error
+            model (across problems, workers, and runs).
+        decoding_window: Defaults to the `DecodingArtifacts` default. The (commit size, buffer size)
+            of the windows matched by the "pymatching_windowed" decoder, in units of the detectors'
+            time coordinate (sub-rounds, for the honeycomb circuits). See `WindowedDecoder`.
+        decoding_processes: Defaults to 1. When larger than 1, each batch is decoded in parallel by
+            a pool of this many worker processes, which is kept for the whole collection (see
+            `DecodingPool`). Meant for a few huge problems, where the decoding of one batch takes
+            long enough to be worth splitting. Can't be combined with `num_workers`.
+        sample_decode_kwargs: Defaults to none. Extra keyword arguments to pass into
+            `sample_decode_count_correct` for every batch, such as `pipeline_chunk_size`.
     """
     print(CSV_HEADER, flush=True)
-    if out_path is not None:
-        if discard_previous_data or not pathlib.Path(out_path).exists():
-            with open(out_path, "w") as f:
-                print(CSV_HEADER, file=f)
+    writer = RecordWriter(out_path, header=CSV_HEADER, discard_previous_data=discard_previous_data)
+    if sample_decode_kwargs is None:
+        sample_decode_kwargs = {}
+    if early_stop_chunk_size is not None:
+        sample_decode_kwargs = {**sample_decode_kwargs, 'early_stop_chunk_size': early_stop_chunk_size}
+    artifacts_kwargs = {
+        'persistent_internal_decoder': persistent_internal_decoder,
+        'lookup_table_dir': lookup_table_dir,
+    }
+    if decoding_window is not None:
+        artifacts_kwargs['decoding_window'] = decoding_window
+    if max_batch_bytes is not None:
+        # Keep each decoder's prediction cache within the memory ceiling, too.
+        artifacts_kwargs['syndrome_cache_bytes'] = min(2**24, max_batch_bytes // 2)
 
     if max_batch is None:
         max_batch = max_shots
+    groups = _group_problems(problems, share_samples=share_samples)
+    scheduler = ProblemScheduler(
+        len(groups),
+        first_batch_size=min(min_shots, max_batch),
+        max_batch=max_batch,
+        max_shots=max_shots,
+        min_seen_logical_errors=min_seen_logical_errors,
+        max_sample_std_dev=max_sample_std_dev,
+        time_budget_seconds=time_budget_seconds,
+        parallelism=num_workers,
+        target_batch_seconds=target_batch_seconds,
+        max_batch_bytes=max_batch_bytes,
+    )
+    if out_path is not None and not discard_previous_data:
+        previous_data = read_recorded_data(out_path)
+        last_batch_sizes = read_last_batch_sizes(out_path)
+        num_resumed = 0
+        for group_index, group in enumerate(groups):
+            recorded = [previous_data.data.get(problem.desc) for problem in group]
+            if all(shot_data is not None for shot_data in recorded):
+                scheduler.record_previous_data(
+                    group_index,
+                    min(recorded, key=lambda e: e.num_errors),
+                    last_batch_size=max(last_batch_sizes[problem.desc] for problem in group),
+                )
+                num_resumed += 1
+        if num_resumed:
+            print(f"Resuming from {out_path}: "
+                  f"{len(scheduler.finished)} of {len(groups)} problems were already finished.",
+                  file=sys.stderr)
 
+    if num_workers > 1:
+        if decoding_processes > 1:
+            raise ValueError("decoding_processes can't be combined with num_workers.")
+        # The writer process opens its own writer.
+        writer.close()
+        _collect_simulated_experiment_data_in_parallel(
+            groups,
+            num_workers=num_workers,
+            scheduler=scheduler,
+            out_path=out_path,
+            shard_log_path=shard_log_path,
+            archive_dir=archive_dir,
+            artifacts_kwargs=artifacts_kwargs,
+            sample_decode_kwargs=sample_decode_kwargs,
+        )
+        return
+
+    # Made (and its workers forked) before sampling starts any threads, or the writer starts its timer.
+    decoding_pool = DecodingPool(num_workers=decoding_processes) if decoding_processes > 1 else None
+    if decoding_pool is not None:
+        sample_decode_kwargs = {**sample_decode_kwargs, 'decoding_pool': decoding_pool}
+    try:
+        with writer:
+            _collect_simulated_experiment_data_sequentially(
+                groups,
+                scheduler=scheduler,
+                writer=writer,
+                archive_dir=archive_dir,
+                artifacts_kwargs=artifacts_kwargs,
+                sample_decode_kwargs=sample_decode_kwargs,
+            )
+    finally:
+        if decoding_pool is not None:
+            decoding_pool.close()
+
+
+def _group_problems(problems: List[DecodingProblem], *, share_samples: bool) -> List[List[DecodingProblem]]:
+    """Groups problems that can be sampled together, keeping the groups in order of first appearance."""
+    if not share_samples:
+        return [[problem] for problem in problems]
+    groups: Dict[DecodingProblemDesc, List[DecodingProblem]] = {}
     for problem in problems:
-        num_seen_errors = 0
-        num_next_shots = min_shots
-        if max_batch is not None and max_batch < min_shots:
-            num_next_shots = max_batch
-        total_shots = 0
+        key = dataclasses.replace(problem.desc, decoder="")
+        groups.setdefault(key, []).append(problem)
+    return list(groups.values())
+
+
+def _group_records(group: List[DecodingProblem],
+                   *,
+                   num_shots: int,
+                   num_corrects: List[int],
+                   seconds: float) -> List[str]:
+    return [
+        _problem_record(problem.desc, num_shots=num_shots, num_correct=num_correct, seconds=seconds / len(group))
+        for problem, num_correct in zip(group, num_corrects)
+    ]
+
+
+def _open_archive(archive_dir: Optional[str], group: List[DecodingProblem],
+                  circuit: stim.Circuit) -> Optional[SyndromeArchive]:
+    if archive_dir is None:
+        return None
+    desc = group[0].desc
+    name = (f"{desc.circuit_style}_{desc.preserved_observable}_{desc.data_width}x{desc.data_height}"
+            f"_r{desc.rounds}_p{desc.noise}")
+    fields = {k: v for k, v in dataclasses.asdict(desc).items() if k != "decoder"}
+    return SyndromeArchive.create(f"{archive_dir}/{name}", circuit=circuit, metadata={"desc": fields})
+
+
+def decode_archive(archive_path: str,
+                   *,
+                   decoders: List[str],
+                   out_path: Optional[str],
+                   chunk_size: int = 2**14):
+    """Decodes the shots saved in a `SyndromeArchive`, and records the results like a sampled batch.
+
+    The archive's shots are streamed from disk in chunks, so they don't need to fit in memory. No
+    sampling is done. Each decoder gets one CSV row (in `CSV_HEADER` format) covering every shot in
+    the archive.
+
+    Args:
+        archive_path: The archive's directory, e.g. as created by the `archive_dir` argument of
+            `collect_simulated_experiment_data`.
+        decoders: The names of the decoders to use. See `sample_decode_count_correct`.
+        out_path: Where to append the CSV rows. Setting this to none doesn't write to file; only
+            writes to stdout.
+        chunk_size: The number of shots to load from disk at a time.
+    """
+    archive = SyndromeArchive(archive_path)
+    num_shots = 0
+    num_corrects = [0] * len(decoders)
+    seconds = [0.0] * len(decoders)
+    with DecodingArtifacts(circuit=archive.circuit) as artifacts:
+        for det_samples, obs_samples in archive.iter_chunks(chunk_size):
+            num_shots += det_samples.shape[0]
+            for k, decoder in enumerate(decoders):
+                t0 = time.monotonic()
+                num_corrects[k] += decode_count_correct(
+                    decoder=decoder,
+                    det_samples=det_samples,
+                    obs_samples=obs_samples,
+                    artifacts=artifacts,
+                )
+                t1 = time.monotonic()
+                seconds[k] += t1 - t0
+
+    print(CSV_HEADER, flush=True)
+    with RecordWriter(out_path, header=CSV_HEADER) as writer:
+        for decoder, num_correct, s in zip(decoders, num_corrects, seconds):
+            desc = DecodingProblemDesc(**archive.metadata["desc"], decoder=decoder)
+            writer.write(_problem_record(desc, num_shots=num_shots, num_correct=num_correct, seconds=s))
+
+
+def _collect_simulated_experiment_data_sequentially(groups: List[List[DecodingProblem]],
+                                                    *,
+                                                    scheduler: 'ProblemScheduler',
+                                                    writer: RecordWriter,
+                                                    archive_dir: Optional[str],
+                                                    artifacts_kwargs: Dict[str, Any],
+                                                    sample_decode_kwargs: Dict[str, Any]):
+    artifacts: Optional[DecodingArtifacts] = None
+    artifacts_index: Optional[int] = None
+    archive: Optional[SyndromeArchive] = None
+    while True:
+        group_index = scheduler.choose_next()
+        if group_index is None:
+            break
+        group = groups[group_index]
+        if artifacts_index != group_index:
+            # Release the cached sampler and decoder of the previous problem before building new ones.
+            if artifacts is not None:
+                _release_artifacts(groups[artifacts_index], artifacts)
+            artifacts = None
+            artifacts = DecodingArtifacts(circuit=group[0].circuit_maker(), **artifacts_kwargs)
+            artifacts_index = group_index
+            archive = _open_archive(archive_dir, group, artifacts.circuit)
+
+        prior = scheduler.shot_data[group_index]
+        t0 = time.monotonic()
+        num_shots, num_corrects = sample_decode_count_shots_correct_per_decoder(
+            num_shots=scheduler.next_batch_size(group_index),
+            artifacts=artifacts,
+            decoders=[problem.desc.decoder for problem in group],
+            is_done=lambda n, cs: scheduler.is_done(ShotData(
+                num_shots=prior.num_shots + n,
+                num_correct=prior.num_correct + max(cs),
+            )),
+            archive=archive,
+            **sample_decode_kwargs,
+        )
+        t1 = time.monotonic()
+        for record in _group_records(group, num_shots=num_shots, num_corrects=num_corrects, seconds=t1 - t0):
+            writer.write(record)
+        # Each batch's rows reach the file before the next batch starts, so a killed run only loses
+        # the batch it was working on.
+        writer.flush()
+        if scheduler.record_batch(
+                group_index,
+                num_shots=num_shots,
+                num_correct=max(num_corrects),
+                seconds=t1 - t0,
+                bytes_per_shot=artifacts.bytes_per_shot):
+            _release_artifacts(group, artifacts)
+            artifacts = None
+            artifacts_index = None
+    if artifacts is not None:
+        artifacts.close()
+
+
+def _release_artifacts(group: List[DecodingProblem], artifacts: DecodingArtifacts):
+    """Reports the cache statistics of a finished problem, and shuts down its decoder processes."""
+    _report_prediction_caches(group, artifacts)
+    artifacts.close()
+
+
+def _report_prediction_caches(group: List[DecodingProblem], artifacts: DecodingArtifacts):
+    """Prints how often decoding was avoided thanks to repeated syndromes, to stderr."""
+    for problem in group:
+        cache = artifacts.prediction_caches.get(problem.desc.decoder)
+        if cache is not None and cache.num_shots:
+            print(f"Syndrome cache hit rate {cache.hit_rate:.1%} "
+                  f"({cache.num_decoded} of {cache.num_shots} shots decoded) for {problem.desc}",
+                  file=sys.stderr)
+    if 'windowed_decoder' in vars(artifacts):
+        windowed = artifacts.windowed_decoder
+        print(f"Windowed decoder built {windowed.num_matching_graphs_built} matching graphs "
+              f"for {len(windowed.windows)} windows for {group[0].desc}",
+              file=sys.stderr)
+    if 'lookup_decoder' in vars(artifacts):
+        print(f"Lookup table miss rate {artifacts.lookup_decoder.miss_rate:.1%} "
+              f"({artifacts.lookup_decoder.num_lookups} syndromes looked up) for {group[0].desc}",
+              file=sys.stderr)
+
+
+def _is_done_sampling(shot_data: 'ShotData',
+                      *,
+                      max_shots: int,
+                      min_seen_logical_errors: int,
+                      max_sample_std_dev: float) -> bool:
+    """The per-problem stopping rule used by `collect_simulated_experiment_data`."""
+    total_shots = shot_data.num_shots
+    num_seen_errors = shot_data.num_errors
+    p = num_seen_errors / total_shots
+    cur_sample_std_dev = math.sqrt(p * (1 - p) / total_shots)
+    if total_shots >= max_shots:
+        return True
+    if num_seen_errors >= min_seen_logical_errors and cur_sample_std_dev <= max_sample_std_dev:
+        return True
+    if num_seen_errors >= total_shots * 0.48 and num_seen_errors >= 10:
+        return True
+    return False
+
+
+class ProblemScheduler:
+    """Decides which problem gets the next batch of shots, and how large that batch is.
+
+    Without a time budget, problems are worked on in order, each one until it meets its stopping
+    rule. With a time budget, every problem first gets one batch to measure how expensive it is.
+    After that the problem whose statistical targets are estimated (by `RemainingWork`) to be the
+    cheapest to reach gets the next batch, and problems that are estimated to not be finishable in
+    the remaining time are abandoned. That way a budgeted run completes as many problems as it can,
+    instead of getting stuck on one expensive low-noise problem.
+
+    Batch sizes start at `first_batch_size`. By default they double after each batch of the same
+    problem. When `target_batch_seconds` is set, the batch size is instead picked so that the batch
+    should take about that many processing seconds (given the measured time per shot so far), and
+    is cut short where the error rate seen so far says `min_seen_logical_errors` will be reached.
+    Batches never exceed `max_batch`, `max_batch_bytes` worth of sampled data, or the shots left
+    before `max_shots`.
+
+    Attributes:
+        shot_data: The statistics collected so far for each problem, by problem index.
+        finished: Indices of problems that met their stopping rule.
+        abandoned: Indices of problems that were given up on due to the time budget.
+        deadline: The `time.monotonic()` time when the budget runs out, or None for no budget.
+    """
+
+    def __init__(self,
+                 num_problems: int,
+                 *,
+                 first_batch_size: int,
+                 max_batch: int,
+                 max_shots: int,
+                 min_seen_logical_errors: int,
+                 max_sample_std_dev: float = 1,
+                 time_budget_seconds: Optional[float] = None,
+                 parallelism: int = 1,
+                 target_batch_seconds: Optional[float] = None,
+                 max_batch_bytes: Optional[int] = None):
+        self.first_batch_size = first_batch_size
+        self.max_batch = max_batch
+        self.max_shots = max_shots
+        self.min_seen_logical_errors = min_seen_logical_errors
+        self.max_sample_std_dev = max_sample_std_dev
+        self.parallelism = parallelism
+        self.target_batch_seconds = target_batch_seconds
+        self.max_batch_bytes = max_batch_bytes
+        self.deadline = None if time_budget_seconds is None else time.monotonic() + time_budget_seconds
+        self.shot_data: List[ShotData] = [ShotData() for _ in range(num_problems)]
+        self.finished: Set[int] = set()
+        self.abandoned: Set[int] = set()
+        self._last_batch_sizes: Dict[int, int] = {}
+        self._bytes_per_shot: Dict[int, int] = {}
+
+    def next_batch_size(self, problem_index: int) -> int:
+        if problem_index not in self._last_batch_sizes:
+            return self.first_batch_size
+        data = self.shot_data[problem_index]
+        limit = min(self.max_batch, self.max_shots - data.num_shots)
+        if self.max_batch_bytes is not None and problem_index in self._bytes_per_shot:
+            limit = min(limit, self.max_batch_bytes // self._bytes_per_shot[problem_index])
+
+        if self.target_batch_seconds is None or data.total_processing_seconds <= 0:
+            size = 2 * self._last_batch_sizes[problem_index]
+        else:
+            size = int(self.target_batch_seconds * data.num_shots / data.total_processing_seconds)
+            if data.num_errors:
+                # Aim 10% past the expected number of shots needed to see enough errors.
+                missing_errors = self.min_seen_logical_errors - data.num_errors
+                if missing_errors > 0:
+                    size = min(size, missing_errors * data.num_shots // data.num_errors * 11 // 10)
+        return max(1, min(size, limit))
+
+    def record_batch(self,
+                     problem_index: int,
+                     *,
+                     num_shots: int,
+                     num_correct: int,
+                     seconds: float,
+                     bytes_per_shot: Optional[int] = None) -> bool:
+        """Adds a batch's results to a problem's statistics, and returns whether the problem is finished.
+
+        Args:
+            problem_index: The problem the batch was taken from.
+            num_shots: The number of shots in the batch.
+            num_correct: The number of shots the decoder got right.
+            seconds: The processing time spent on the batch.
+            bytes_per_shot: How much sampled data each shot of the problem occupies, if known. Used
+                to respect `max_batch_bytes`.
+        """
+        data = self.shot_data[problem_index]
+        data.num_shots += num_shots
+        data.num_correct += num_correct
+        data.total_processing_seconds += seconds
+        self._last_batch_sizes[problem_index] = num_shots
+        if bytes_per_shot is not None:
+            self._bytes_per_shot[problem_index] = bytes_per_shot
+        if self.is_done(data):
+            self.finished.add(problem_index)
+            return True
+        return False
+
+    def record_previous_data(self, problem_index: int, shot_data: 'ShotData', *, last_batch_size: int) -> bool:
+        """Credits a problem with results recorded by an earlier run, and returns whether it is finished.
+
+        Args:
+            problem_index: The problem the results belong to.
+            shot_data: The problem's recorded statistics.
+            last_batch_size: The number of shots in the last recorded batch. Batch sizes continue
+                from it, instead of from the total number of recorded shots.
+        """
+        data = self.shot_data[problem_index]
+        data.num_shots += shot_data.num_shots
+        data.num_correct += shot_data.num_correct
+        data.total_processing_seconds += shot_data.total_processing_seconds
+        self._last_batch_sizes[problem_index] = last_batch_size
+        if self.is_done(data):
+            self.finished.add(problem_index)
+            return True
+        return False
+
+    def is_done(self, shot_data: 'ShotData') -> bool:
+        """Determines if a problem with the given statistics has met its stopping rule."""
+        return _is_done_sampling(
+            shot_data,
+            max_shots=self.max_shots,
+            min_seen_logical_errors=self.min_seen_logical_errors,
+            max_sample_std_dev=self.max_sample_std_dev)
+
+    def estimated_remaining_seconds(self, problem_index: int) -> float:
+        return self.shot_data[problem_index].remaining_work(
+            max_shots=self.max_shots,
+            max_errors=self.min_seen_logical_errors,
+            threshold_circuit_breaker=0.48,
+        ).remaining_time
+
+    def choose_next(self, *, exclude: Iterable[int] = ()) -> Optional[int]:
+        """Returns the index of the problem that should get the next batch, or None if there isn't one.
+
+        Args:
+            exclude: Problems that can't be picked, e.g. because other workers are busy with them.
+        """
+        exclude = set(exclude)
+        candidates = [
+            k
+            for k in range(len(self.shot_data))
+            if k not in self.finished and k not in self.abandoned and k not in exclude
+        ]
+        if self.deadline is None:
+            return candidates[0] if candidates else None
+
+        time_left = self.deadline - time.monotonic()
+        if time_left <= 0:
+            self.abandoned.update(k for k in range(len(self.shot_data)) if k not in self.finished)
+            return None
+
+        # Measure the cost of every problem before comparing them.
+        for k in candidates:
+            if self.shot_data[k].num_shots == 0:
+                return k
+
+        best = None
+        best_cost = None
+        for k in candidates:
+            cost = self.estimated_remaining_seconds(k)
+            if cost > time_left * self.parallelism:
+                self.abandoned.add(k)
+            elif best_cost is None or cost < best_cost:
+                best = k
+                best_cost = cost
+        return best
+
+
+def _problem_record(desc: DecodingProblemDesc, *, num_shots: int, num_correct: int, seconds: float) -> str:
+    return ",".join(str(e) for e in [
+        desc.data_width,
+        desc.data_height,
+        desc.rounds,
+        desc.noise,
+        desc.circuit_style,
+        desc.preserved_observable,
+        desc.code_distance,
+        desc.num_qubits,
+        num_shots,
+        num_correct,
+        seconds,
+        desc.decoder,
+        CSV_HEADER_VERSION,
+    ])
+
+
+def _write_records_until_done(records: multiprocessing.Queue,
+                              out_path: Optional[str],
+                              shard_log_path: Optional[str]):
+    """Body of the writer process. The writer is the only process that touches the output files.
+
+    Queue items are `(is_shard, line)` pairs. Shard lines only go to `shard_log_path`. A `None` item
+    shuts the writer down.
+    """
+    with RecordWriter(out_path) as writer, \
+            RecordWriter(shard_log_path, header=SHARD_LOG_HEADER, echo=False) as shard_writer:
         while True:
+            item = records.get()
+            if item is None:
+                return
+            is_shard, line = item
+            if is_shard:
+                shard_writer.write(line)
+            else:
+                writer.write(line)
+            # Rows are flushed once the rows queued so far are written, so that a killed run only
+            # loses the batches it was working on.
+            if records.empty():
+                writer.flush()
+                shard_writer.flush()
+
+
+@dataclasses.dataclass
+class _WorkerTask:
+    """A request for a worker process to sample and decode a batch, or a shard of a batch.
+
+    Attributes:
+        problem_index: The problem (group of problems sharing samples) to work on.
+        num_shots: The number of shots to take. None means the problem is finished and its cached
+            artifacts can be released.
+        seed: The seed for the shard's sampler, or None to use the unseeded cached sampler.
+        prior: The problem's statistics before the batch, for checking the stopping rule early.
+        num_shards: The number of shards the batch was split into.
+    """
+    problem_index: int
+    num_shots: Optional[int]
+    seed: Optional[int] = None
+    prior: Optional['ShotData'] = None
+    num_shards: int = 1
+
+
+def _sample_in_worker(groups: List[List[DecodingProblem]],
+                      tasks: multiprocessing.Queue,
+                      results: multiprocessing.Queue,
+                      worker_id: int,
+                      is_done: Callable[['ShotData'], bool],
+                      archive_dir: Optional[str],
+                      artifacts_kwargs: Dict[str, Any],
+                      sample_decode_kwargs: Dict[str, Any]):
+    """Body of a worker process.
+
+    Reads `_WorkerTask`s from `tasks` until getting a `None`, which shuts the worker down.
+    """
+    cache: Dict[int, DecodingArtifacts] = {}
+    archives: Dict[int, Optional[SyndromeArchive]] = {}
+    while True:
+        task: Optional[_WorkerTask] = tasks.get()
+        if task is None:
+            for artifacts in cache.values():
+                artifacts.close()
+            return
+        problem_index = task.problem_index
+        if task.num_shots is None:
+            if problem_index in cache:
+                _release_artifacts(groups[problem_index], cache.pop(problem_index))
+            archives.pop(problem_index, None)
+            continue
+        try:
+            group = groups[problem_index]
+            if problem_index not in cache:
+                cache[problem_index] = DecodingArtifacts(circuit=group[0].circuit_maker(), **artifacts_kwargs)
+                archives[problem_index] = _open_archive(archive_dir, group, cache[problem_index].circuit)
+            prior = task.prior
+            num_shards = task.num_shards
             t0 = time.monotonic()
-            num_correct = sample_decode_count_correct(
-                num_shots=num_next_shots,
-                circuit=problem.circuit_maker(),
-                decoder=problem.desc.decoder,
+            num_shots, num_corrects = sample_decode_count_shots_correct_per_decoder(
+                num_shots=task.num_shots,
+                artifacts=cache[problem_index],
+                decoders=[problem.desc.decoder for problem in group],
+                seed=task.seed,
+                is_done=lambda n, cs: is_done(ShotData(
+                    num_shots=prior.num_shots + n * num_shards,
+                    num_correct=prior.num_correct + max(cs) * num_shards,
+                )),
+                archive=archives[problem_index],
+                **sample_decode_kwargs,
             )
             t1 = time.monotonic()
-            record = ",".join(str(e) for e in [
+            bytes_per_shot = cache[problem_index].bytes_per_shot
+        except BaseException:
+            results.put((worker_id, problem_index, traceback.format_exc()))
+            for artifacts in cache.values():
+                artifacts.close()
+            return
+        results.put((worker_id, problem_index, (num_shots, num_corrects, t1 - t0, task.seed, bytes_per_shot)))
+
+
+@dataclasses.dataclass
+class _ActiveProblem:
+    """Bookkeeping for a problem that is being sampled by worker processes."""
+    workers: List[int]
+    batch_shots: int = 0
+    batch_corrects: Optional[List[int]] = None
+    batch_seconds: float = 0
+    num_pending_shards: int = 0
+
+
+# How often the coordinator of the worker processes checks that they are still alive, while waiting
+# for their results.
+_WORKER_POLL_SECONDS = 1
+
+
+def _has_high_setup_cost(group: List[DecodingProblem]) -> bool:
+    return any(get_decoder(problem.desc.decoder).setup_cost == "high" for problem in group)
+
+
+def _split_evenly(total: int, parts: int) -> List[int]:
+    return [total // parts + (k < total % parts) for k in range(parts)]
+
+
+def _collect_simulated_experiment_data_in_parallel(groups: List[List[DecodingProblem]],
+                                                   *,
+                                                   num_workers: int,
+                                                   scheduler: ProblemScheduler,
+                                                   out_path: Optional[str],
+                                                   shard_log_path: Optional[str],
+                                                   archive_dir: Optional[str],
+                                                   artifacts_kwargs: Dict[str, Any],
+                                                   sample_decode_kwargs: Dict[str, Any]):
+    """Samples problems using worker processes, with a writer process appending results to `out_path`.
+
+    The calling process does the bookkeeping. Each problem being sampled is worked on by a group of
+    workers, which keep the problem's sampler and decoder cached while the scheduler keeps choosing
+    that problem. A worker with nothing to do starts the problem chosen by the scheduler or, when
+    there are none left to start, joins the active problem with the fewest workers (unless the
+    problem's decoders are expensive to set up, see `DecoderBackend.setup_cost`, or its batches are
+    too small to give the worker a shard). A batch is split into shards, one per worker in the
+    group, with each shard sampled by a sampler seeded from an independent seed stream. The shards
+    are merged into one batch (and one CSV row) before the stopping rule is evaluated.
+
+    If a worker process dies without reporting back (e.g. it is killed for running out of memory),
+    a RuntimeError is raised after shutting down the writer and the other workers.
+
+    Uses the fork start method, so that problems whose circuit makers can't be pickled still work.
+    """
+    ctx = multiprocessing.get_context("fork")
+    records = ctx.Queue()
+    results = ctx.Queue()
+    writer = ctx.Process(target=_write_records_until_done, args=(records, out_path, shard_log_path))
+    writer.start()
+    task_queues = [ctx.Queue() for _ in range(num_workers)]
+    workers = [
+        ctx.Process(
+            target=_sample_in_worker,
+            args=(groups, task_queues[k], results, k, scheduler.is_done, archive_dir, artifacts_kwargs,
+                  sample_decode_kwargs),
+            daemon=True,
+        )
+        for k in range(num_workers)
+    ]
+    for w in workers:
+        w.start()
+
+    try:
+        seed_sequence = np.random.SeedSequence()
+        idle_workers = list(range(num_workers))
+        active: Dict[int, _ActiveProblem] = {}
+
+        def max_shards(problem_index: int) -> int:
+            # Don't bother splitting into shards smaller than the first batch.
+            return max(1, scheduler.next_batch_size(problem_index) // scheduler.first_batch_size)
+
+        def dispatch_batch(problem_index: int):
+            a = active[problem_index]
+            batch_size = scheduler.next_batch_size(problem_index)
+            num_shards = min(len(a.workers), max_shards(problem_index))
+            # Workers that wouldn't get a shard of this batch go back to being idle.
+            for worker_id in a.workers[num_shards:]:
+                task_queues[worker_id].put(_WorkerTask(problem_index=problem_index, num_shots=None))
+                idle_workers.append(worker_id)
+            del a.workers[num_shards:]
+            if num_shards == 1:
+                seeds = [None]
+            else:
+                seeds = [int(s.generate_state(1, dtype=np.uint64)[0]) for s in seed_sequence.spawn(num_shards)]
+            a.batch_shots = 0
+            a.batch_corrects = [0] * len(groups[problem_index])
+            a.batch_seconds = 0
+            a.num_pending_shards = num_shards
+            for worker_id, shard_size, seed in zip(a.workers, _split_evenly(batch_size, num_shards), seeds):
+                task_queues[worker_id].put(_WorkerTask(
+                    problem_index=problem_index,
+                    num_shots=shard_size,
+                    seed=seed,
+                    prior=scheduler.shot_data[problem_index],
+                    num_shards=num_shards,
+                ))
+
+        def assign_idle_workers():
+            while idle_workers:
+                worker_id = idle_workers.pop()
+                problem_index = scheduler.choose_next(exclude=active.keys())
+                joinable = [
+                    a
+                    for k, a in active.items()
+                    if not _has_high_setup_cost(groups[k]) and len(a.workers) < max_shards(k)
+                ]
+                if problem_index is not None:
+                    active[problem_index] = _ActiveProblem(workers=[worker_id])
+                    dispatch_batch(problem_index)
+                elif joinable:
+                    # Joins in when the problem's next batch is dispatched.
+                    min(joinable, key=lambda e: len(e.workers)).workers.append(worker_id)
+                else:
+                    idle_workers.append(worker_id)
+                    return
+
+        def next_result() -> Tuple[int, int, Any]:
+            # A worker that is killed (e.g. by running out of memory) never reports back, so its
+            # death is noticed by polling instead of waiting forever.
+            while True:
+                try:
+                    return results.get(timeout=_WORKER_POLL_SECONDS)
+                except queue.Empty:
+                    for k, w in enumerate(workers):
+                        if w.exitcode is not None:
+                            raise RuntimeError(f"Worker {k} died unexpectedly (exit code {w.exitcode}).")
+
+        assign_idle_workers()
+        while active:
+            worker_id, problem_index, result = next_result()
+            if isinstance(result, str):
+                raise RuntimeError(f"Worker failed on {groups[problem_index][0].desc}:\n{result}")
+            num_shots, num_corrects, seconds, seed, bytes_per_shot = result
+            group = groups[problem_index]
+            if seed is not None:
+                for record in _group_records(group, num_shots=num_shots, num_corrects=num_corrects, seconds=seconds):
+                    records.put((True, record + f",{seed}"))
+
+            a = active[problem_index]
+            a.batch_shots += num_shots
+            a.batch_corrects = [c1 + c2 for c1, c2 in zip(a.batch_corrects, num_corrects)]
+            a.batch_seconds += seconds
+            a.num_pending_shards -= 1
+            if a.num_pending_shards:
+                continue
+
+            for record in _group_records(
+                    group,
+                    num_shots=a.batch_shots,
+                    num_corrects=a.batch_corrects,
+                    seconds=a.batch_seconds):
+                records.put((False, record))
+            finished = scheduler.record_batch(
+                problem_index,
+                num_shots=a.batch_shots,
+                num_correct=max(a.batch_corrects),
+                seconds=a.batch_seconds,
+                bytes_per_shot=bytes_per_shot,
+            )
+            other_active = [k for k in active.keys() if k != problem_index]
+            if not finished and scheduler.choose_next(exclude=other_active) == problem_index:
+                dispatch_batch(problem_index)
+                assign_idle_workers()
+                continue
+
+            for worker_id in a.workers:
+                task_queues[worker_id].put(_WorkerTask(problem_index=problem_index, num_shots=None))
+            idle_workers.extend(a.workers)
+            del active[problem_index]
+            assign_idle_workers()
+    finally:
+        for q in task_queues:
+            q.put(None)
+        records.put(None)
+        writer.join()
+        for w in workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+
+
+def collect_detection_fraction_data(problems: List[DecodingProblem],
+                                    *,
+                                    shots: int,
+                                    out_path: Optional[str],
+                                    discard_previous_data: bool):
+    print(CSV_HEADER, flush=True)
+    with RecordWriter(out_path, header=CSV_HEADER, discard_previous_data=discard_previous_data) as writer:
+        for problem in problems:
+            t0 = time.monotonic()
+            samples = problem.circuit_maker().compile_detector_sampler().sample(shots)
+            num_detections = np.count_nonzero(samples)
+            num_samples = math.prod(samples.shape)
+            t1 = time.monotonic()
+            writer.write(",".join(str(e) for e in [
                 problem.desc.data_width,
                 problem.desc.data_height,
                 problem.desc.rounds,
                 problem.desc.noise,
                 problem.desc.circuit_style,
-                problem.desc.preserved_observable,
+                "-",
                 problem.desc.code_distance,
                 problem.desc.num_qubits,
-                num_next_shots,
-                num_correct,
+                num_samples,
+                num_samples - num_detections,
                 t1 - t0,
-                problem.desc.decoder,
+                "detection_fraction",
                 CSV_HEADER_VERSION,
-            ])
-            if out_path is not None:
-                with open(out_path, "a") as f:
-                    print(record, file=f)
-            print(record, flush=True)
-
-            total_shots += num_next_shots
-            num_seen_errors += num_next_shots - num_correct
-            p = num_seen_errors / total_shots
-            cur_sample_std_dev = math.sqrt(p * (1 - p) / total_shots)
-            if total_shots >= max_shots:
-                break
-            if num_seen_errors >= min_seen_logical_errors and cur_sample_std_dev <= max_sample_std_dev:
-                break
-            if num_seen_errors >= total_shots * 0.48 and num_seen_errors >= 10:
-                break
-            num_next_shots = min(max_batch, min(2 * num_next_shots, max_shots - total_shots))
-
-
-def collect_detection_fraction_data(problems: List[DecodingProblem],
-                                    *,
-                                    shots: int,
-                                    out_path: Optional[str],
-                                    discard_previous_data: bool):
-    print(CSV_HEADER, flush=True)
-    if out_path is not None:
-        if discard_previous_data or not pathlib.Path(out_path).exists():
-            with open(out_path, "w") as f:
-                print(CSV_HEADER, file=f)
-
-    for problem in problems:
-        t0 = time.monotonic()
-        samples = problem.circuit_maker().compile_detector_sampler().sample(shots)
-        num_detections = np.count_nonzero(samples)
-        num_samples = math.prod(samples.shape)
-        t1 = time.monotonic()
-        record = ",".join(str(e) for e in [
-            problem.desc.data_width,
-            problem.desc.data_height,
-            problem.desc.rounds,
-            problem.desc.noise,
-            problem.desc.circuit_style,
-            "-",
-            problem.desc.code_distance,
-            problem.desc.num_qubits,
-            num_samples,
-            num_samples - num_detections,
-            t1 - t0,
-            "detection_fraction",
-            CSV_HEADER_VERSION,
-        ])
-        if out_path is not None:
-            with open(out_path, "a") as f:
-                print(record, file=f)
-        print(record, flush=True)
+            ]))
 
 
 @dataclasses.dataclass
@@ -346,19 +1097,29 @@ def read_recorded_data(*paths: str) -> ProblemShotData:
     for path in paths:
         with open(path, "r") as f:
             for row in csv.DictReader(f):
-                key = DecodingProblemDesc(
-                    code_distance=int(row["code_distance"]),
-                    num_qubits=int(row["num_qubits"]),
-                    data_width=int(row["data_width"]),
-                    data_height=int(row["data_height"]),
-                    rounds=int(row["rounds"]),
-                    noise=float(row["noise"]),
-                    circuit_style=row["circuit_style"],
-                    preserved_observable=row["preserved_observable"],
-                    decoder=row["decoder"],
-                )
+                key = _recorded_problem_desc(row)
                 val = result.data.setdefault(key, ShotData())
                 val.num_shots += int(row["num_shots"])
                 val.num_correct += int(row["num_correct"])
                 val.total_processing_seconds += float(row["total_processing_seconds"])
     return result
+
+
+def read_last_batch_sizes(path: str) -> Dict[DecodingProblemDesc, int]:
+    """Returns the number of shots in the last row recorded for each problem."""
+    with open(path, "r") as f:
+        return {_recorded_problem_desc(row): int(row["num_shots"]) for row in csv.DictReader(f)}
+
+
+def _recorded_problem_desc(row: Dict[str, str]) -> DecodingProblemDesc:
+    return DecodingProblemDesc(
+        code_distance=int(row["code_distance"]),
+        num_qubits=int(row["num_qubits"]),
+        data_width=int(row["data_width"]),
+        data_height=int(row["data_height"]),
+        rounds=int(row["rounds"]),
+        noise=float(row["noise"]),
+        circuit_style=row["circuit_style"],
+        preserved_observable=row["preserved_observable"],
+        decoder=row["decoder"],
+    )
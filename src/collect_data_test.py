@@ -1,9 +1,16 @@
+import csv
+import os
+import pathlib
+import signal
 import tempfile
 
 import numpy as np
 import pytest
 
-from collect_data import collect_simulated_experiment_data, ShotData, read_recorded_data
+from collect_data import collect_simulated_experiment_data, ShotData, read_recorded_data, CSV_HEADER, \
+    ProblemScheduler, _group_problems, decode_archive
+from decoder_registry import DecoderBackend, register_decoder, unregister_decoder
+from decoding import sample_decode_count_correct, internal_decoder_path
 from honeycomb_layout import HoneycombLayout
 from plotting import plot_data
 from probability_util import log_binomial
@@ -36,6 +43,306 @@ def test_collect_and_plot():
         plot_data(read_recorded_data(f), show=False, out_path=d + "/tmp.png", title="Test")
 
 
+def test_collect_in_parallel():
+    problems = [
+        HoneycombLayout(
+            noise=p,
+            data_width=2 * d,
+            data_height=6 * d,
+            sub_rounds=30,
+            style="SD6",
+            obs="V",
+        ).as_decoder_problem("pymatching")
+        for p in [1e-4, 1e-3]
+        for d in [1, 2]
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        collect_simulated_experiment_data(
+            problems,
+            out_path=f,
+            discard_previous_data=True,
+            min_shots=10,
+            max_shots=100,
+            max_batch=40,
+            min_seen_logical_errors=10**9,
+            num_workers=3,
+        )
+        data = read_recorded_data(f)
+        with open(f) as file:
+            lines = file.read().splitlines()
+
+    assert lines[0] == CSV_HEADER
+    # Batches of 10, 20, 40, then the remaining 30.
+    assert len(lines) == 1 + 4 * len(problems)
+    assert sorted(data.data.keys()) == sorted(p.desc for p in problems)
+    for v in data.data.values():
+        assert v.num_shots == 100
+
+
+def test_collect_in_parallel_fails_when_a_worker_is_killed(tmp_path):
+    parent_pid = os.getpid()
+
+    def decode(dets: np.ndarray, *, artifacts) -> np.ndarray:
+        if os.getpid() != parent_pid:
+            # Like being killed for running out of memory, in the middle of a batch.
+            os.kill(os.getpid(), signal.SIGKILL)
+        return np.zeros((dets.shape[0], 1), dtype=np.uint8)
+
+    register_decoder(DecoderBackend(name="test_killed_worker", decode=decode, bit_packed=True))
+    try:
+        problem = HoneycombLayout(
+            noise=1e-3,
+            data_width=2,
+            data_height=6,
+            sub_rounds=30,
+            style="SD6",
+            obs="V",
+        ).as_decoder_problem("test_killed_worker")
+        with pytest.raises(RuntimeError, match="died unexpectedly"):
+            collect_simulated_experiment_data(
+                [problem],
+                out_path=str(tmp_path / "tmp.csv"),
+                discard_previous_data=True,
+                min_shots=10,
+                max_shots=100,
+                min_seen_logical_errors=10**9,
+                num_workers=2,
+            )
+    finally:
+        unregister_decoder("test_killed_worker")
+
+
+def test_collect_in_parallel_shards_batches():
+    problem = HoneycombLayout(
+        noise=1e-3,
+        data_width=2,
+        data_height=6,
+        sub_rounds=30,
+        style="SD6",
+        obs="V",
+    ).as_decoder_problem("pymatching")
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        shard_log = d + "/shards.csv"
+        collect_simulated_experiment_data(
+            [problem],
+            out_path=f,
+            shard_log_path=shard_log,
+            discard_previous_data=True,
+            min_shots=10,
+            max_shots=150,
+            max_batch=40,
+            min_seen_logical_errors=10**9,
+            num_workers=4,
+        )
+        data = read_recorded_data(f)
+        with open(shard_log) as file:
+            shards = list(csv.DictReader(file))
+
+    assert data.data[problem.desc].num_shots == 150
+    assert len(shards) > 1
+    assert sum(int(row["num_shots"]) for row in shards) < 150
+    row = shards[0]
+    assert int(row["num_correct"]) == sample_decode_count_correct(
+        circuit=problem.circuit_maker(),
+        num_shots=int(row["num_shots"]),
+        decoder="pymatching",
+        seed=int(row["seed"]),
+    )
+
+
+def test_early_stopped_shards_can_be_rerun():
+    problem = HoneycombLayout(
+        noise=1e-3,
+        data_width=2,
+        data_height=6,
+        sub_rounds=30,
+        style="SD6",
+        obs="V",
+    ).as_decoder_problem("pymatching")
+    with tempfile.TemporaryDirectory() as d:
+        shard_log = d + "/shards.csv"
+        collect_simulated_experiment_data(
+            [problem],
+            out_path=None,
+            shard_log_path=shard_log,
+            discard_previous_data=True,
+            min_shots=20,
+            max_shots=5000,
+            max_batch=400,
+            min_seen_logical_errors=60,
+            num_workers=3,
+            early_stop_chunk_size=7,
+        )
+        with open(shard_log) as file:
+            shards = list(csv.DictReader(file))
+
+    assert len(shards) > 1
+    # The shards were sampled in chunks of 7 shots, and may have stopped after any of them.
+    for row in shards:
+        assert int(row["num_correct"]) == sample_decode_count_correct(
+            circuit=problem.circuit_maker(),
+            num_shots=int(row["num_shots"]),
+            decoder="pymatching",
+            seed=int(row["seed"]),
+        )
+
+
+def test_problem_scheduler_without_budget_goes_in_order():
+    scheduler = ProblemScheduler(
+        3,
+        first_batch_size=10,
+        max_batch=30,
+        max_shots=100,
+        min_seen_logical_errors=5,
+    )
+    assert scheduler.choose_next() == 0
+    assert scheduler.next_batch_size(0) == 10
+    assert not scheduler.record_batch(0, num_shots=10, num_correct=10, seconds=1)
+    assert scheduler.next_batch_size(0) == 20
+    assert not scheduler.record_batch(0, num_shots=20, num_correct=20, seconds=1)
+    assert scheduler.next_batch_size(0) == 30
+    assert scheduler.choose_next() == 0
+    assert scheduler.choose_next(exclude=[0]) == 1
+    assert scheduler.record_batch(0, num_shots=30, num_correct=20, seconds=1)
+    assert scheduler.choose_next() == 1
+    assert scheduler.finished == {0}
+
+
+def test_problem_scheduler_credits_previous_data_without_a_batch():
+    scheduler = ProblemScheduler(
+        2,
+        first_batch_size=10,
+        max_batch=1000,
+        max_shots=100,
+        min_seen_logical_errors=5,
+    )
+    # Batches of 10, 20 and 40 shots were recorded.
+    assert not scheduler.record_previous_data(0, ShotData(num_shots=70, num_correct=70), last_batch_size=40)
+    assert scheduler.shot_data[0].num_shots == 70
+    # Batch sizes keep doubling from the last batch, instead of from the recorded total.
+    assert scheduler.next_batch_size(0) == 30
+    scheduler.max_shots = 1000
+    assert scheduler.next_batch_size(0) == 80
+    assert scheduler.record_previous_data(1, ShotData(num_shots=1000, num_correct=990), last_batch_size=500)
+    assert scheduler.finished == {1}
+
+
+def test_problem_scheduler_with_budget_prefers_cheap_problems():
+    scheduler = ProblemScheduler(
+        3,
+        first_batch_size=100,
+        max_batch=1000,
+        max_shots=10**6,
+        min_seen_logical_errors=100,
+        time_budget_seconds=1000,
+    )
+
+    # Every problem gets measured first.
+    for k in range(3):
+        assert scheduler.choose_next() == k
+        scheduler.record_batch(k, num_shots=100, num_correct=100 - 10 * (k + 1), seconds=1)
+
+    # Problem 2 sees errors fastest.
+    assert scheduler.choose_next() == 2
+    assert scheduler.choose_next(exclude=[2]) == 1
+
+    # Problem 0 becomes too expensive to finish in the time that's left.
+    scheduler.record_batch(0, num_shots=1000, num_correct=1000, seconds=10**4)
+    assert scheduler.choose_next(exclude=[1, 2]) is None
+    assert scheduler.abandoned == {0}
+
+
+def test_problem_scheduler_targets_batch_seconds():
+    scheduler = ProblemScheduler(
+        1,
+        first_batch_size=100,
+        max_batch=10**6,
+        max_shots=10**7,
+        min_seen_logical_errors=100,
+        target_batch_seconds=10,
+        max_batch_bytes=10**5,
+    )
+    assert scheduler.next_batch_size(0) == 100
+    scheduler.record_batch(0, num_shots=100, num_correct=100, seconds=0.1)
+    assert scheduler.next_batch_size(0) == 10000
+
+    # Stop slightly past where the errors are expected to be seen.
+    scheduler.record_batch(0, num_shots=9900, num_correct=9850, seconds=4.9)
+    assert scheduler.next_batch_size(0) == 11000
+
+    # Respect the memory ceiling.
+    scheduler.record_batch(0, num_shots=10, num_correct=10, seconds=0.01, bytes_per_shot=100)
+    assert scheduler.next_batch_size(0) == 1000
+
+
+def test_collect_with_time_budget():
+    problems = [
+        HoneycombLayout(
+            noise=p,
+            data_width=2,
+            data_height=6,
+            sub_rounds=30,
+            style="SD6",
+            obs="V",
+        ).as_decoder_problem("pymatching")
+        for p in [1e-3, 1e-2]
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        collect_simulated_experiment_data(
+            problems,
+            out_path=f,
+            discard_previous_data=True,
+            min_shots=10,
+            max_shots=200,
+            min_seen_logical_errors=10,
+            time_budget_seconds=60,
+        )
+        data = read_recorded_data(f)
+    assert sorted(data.data.keys()) == sorted(p.desc for p in problems)
+
+
+def test_collect_resumes_from_previous_data(capsys):
+    problems = [
+        HoneycombLayout(
+            noise=p,
+            data_width=2,
+            data_height=6,
+            sub_rounds=30,
+            style="SD6",
+            obs="V",
+        ).as_decoder_problem("pymatching")
+        for p in [1e-4, 1e-3]
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+
+        def collect(max_shots: int, discard_previous_data: bool):
+            collect_simulated_experiment_data(
+                problems,
+                out_path=f,
+                discard_previous_data=discard_previous_data,
+                min_shots=10,
+                max_shots=max_shots,
+                min_seen_logical_errors=10**9,
+            )
+            with open(f) as file:
+                return len(file.read().splitlines())
+
+        # Nothing to resume from in a fresh file.
+        num_lines = collect(max_shots=70, discard_previous_data=False)
+        assert "Resuming" not in capsys.readouterr().err
+        # Everything is already finished.
+        assert collect(max_shots=70, discard_previous_data=False) == num_lines
+        assert "2 of 2 problems were already finished" in capsys.readouterr().err
+        # Continues from 70 shots instead of starting over.
+        assert collect(max_shots=100, discard_previous_data=False) == num_lines + 2
+        data = read_recorded_data(f)
+
+    for v in data.data.values():
+        assert v.num_shots == 100
 
 
 def test_likely_error_rate_bounds_shrink_towards_half():
@@ -91,3 +398,138 @@ def test_likely_error_rate_bounds_vs_log_binomial(n: int, c: int, ratio: float):
         ratio,
         rtol=1e-2,
     )
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_collect_stops_mid_batch(num_workers: int):
+    problems = [
+        HoneycombLayout(
+            noise=1e-2,
+            data_width=2,
+            data_height=6,
+            sub_rounds=30,
+            style="SD6",
+            obs="V",
+        ).as_decoder_problem("pymatching")
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        collect_simulated_experiment_data(
+            problems,
+            out_path=f,
+            discard_previous_data=True,
+            min_shots=1000,
+            max_shots=1000,
+            min_seen_logical_errors=10,
+            num_workers=num_workers,
+            early_stop_chunk_size=50,
+        )
+        data = read_recorded_data(f)
+    shot_data = data.data[problems[0].desc]
+    assert shot_data.num_shots < 1000
+    assert shot_data.num_shots % 50 == 0
+
+
+def test_group_problems_by_circuit():
+    layouts = [
+        HoneycombLayout(noise=p, data_width=2, data_height=6, sub_rounds=30, style="SD6", obs="V")
+        for p in [1e-3, 1e-2]
+    ]
+    problems = [
+        layout.as_decoder_problem(decoder)
+        for layout in layouts
+        for decoder in ["internal", "internal_correlated"]
+    ]
+    assert _group_problems(problems, share_samples=False) == [[p] for p in problems]
+    assert _group_problems(problems, share_samples=True) == [problems[:2], problems[2:]]
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_collect_sharing_samples(num_workers: int):
+    layouts = [
+        HoneycombLayout(noise=p, data_width=2, data_height=6, sub_rounds=30, style="SD6", obs="V")
+        for p in [1e-4, 1e-3]
+    ]
+    decoders = ["pymatching"]
+    if internal_decoder_path() is not None:
+        decoders.append("internal")
+    problems = [layout.as_decoder_problem(decoder) for layout in layouts for decoder in decoders]
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        collect_simulated_experiment_data(
+            problems,
+            out_path=f,
+            discard_previous_data=True,
+            min_shots=100,
+            max_shots=200,
+            min_seen_logical_errors=10,
+            num_workers=num_workers,
+            share_samples=True,
+        )
+        data = read_recorded_data(f)
+    assert sorted(data.data.keys()) == sorted(p.desc for p in problems)
+    for p in problems:
+        assert data.data[p.desc].num_shots == data.data[problems[0].desc.with_changes(
+            noise=p.desc.noise)].num_shots
+        assert 100 <= data.data[p.desc].num_shots <= 200
+
+
+def test_decode_archive_reproduces_collected_results():
+    problem = HoneycombLayout(
+        noise=1e-3,
+        data_width=2,
+        data_height=6,
+        sub_rounds=30,
+        style="SD6",
+        obs="V",
+    ).as_decoder_problem("pymatching")
+    with tempfile.TemporaryDirectory() as d:
+        collect_simulated_experiment_data(
+            [problem],
+            out_path=d + "/collected.csv",
+            discard_previous_data=True,
+            min_shots=100,
+            max_shots=300,
+            min_seen_logical_errors=10**6,
+            archive_dir=d + "/archive",
+        )
+        (archive_path,) = pathlib.Path(d, "archive").iterdir()
+        decode_archive(str(archive_path), decoders=["pymatching"], out_path=d + "/decoded.csv")
+        collected = read_recorded_data(d + "/collected.csv").data[problem.desc]
+        decoded = read_recorded_data(d + "/decoded.csv").data[problem.desc]
+    assert decoded.num_shots == collected.num_shots == 300
+    assert decoded.num_correct == collected.num_correct
+
+
+def test_collect_with_decoding_processes(tmp_path):
+    problem = HoneycombLayout(
+        noise=1e-3,
+        data_width=2,
+        data_height=6,
+        sub_rounds=30,
+        style="SD6",
+        obs="V",
+    ).as_decoder_problem("pymatching")
+    f = str(tmp_path / "tmp.csv")
+    collect_simulated_experiment_data(
+        [problem],
+        out_path=f,
+        discard_previous_data=True,
+        min_shots=300,
+        max_shots=1200,
+        min_seen_logical_errors=10**9,
+        decoding_processes=2,
+    )
+    assert read_recorded_data(f).data[problem.desc].num_shots == 1200
+
+    with pytest.raises(ValueError, match="decoding_processes"):
+        collect_simulated_experiment_data(
+            [problem],
+            out_path=None,
+            discard_previous_data=True,
+            min_shots=10,
+            max_shots=10,
+            min_seen_logical_errors=1,
+            num_workers=2,
+            decoding_processes=2,
+        )
@@ -0,0 +1,85 @@
+"""This file contains the registry of decoders that can be named when sampling and decoding."""
+
+import dataclasses
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+@dataclasses.dataclass(frozen=True)
+class DecoderBackend:
+    """A named decoder, and the capabilities that decide how it is fed shots.
+
+    Attributes:
+        name: The name used to ask for the decoder, e.g. in `DecodingProblemDesc.decoder`.
+        decode: Called as `decode(det_samples, artifacts=artifacts)` with `DecodingArtifacts` of
+            the circuit being decoded, and returns the predicted observable flips. The shape and
+            encoding of the detection events and predictions depend on `batch` and `bit_packed`.
+        batch: Whether `decode` takes a 2d array with one row per shot and returns one row of
+            predictions per shot. Otherwise it takes and returns the 1d row of a single shot.
+        bit_packed: Whether `decode` takes detection events and returns predictions bit packed
+            (little endian) along their last axis. Otherwise they are unpacked bool arrays.
+        correlated: Whether the decoder accounts for correlations between the X and Z parts of
+            errors, instead of decoding them independently.
+        thread_safe: Whether `decode` can be called from several threads at once. Thread safe
+            decoders that decode the same samples as other decoders are run concurrently.
+        setup_cost: "low" or "high". How expensive it is to prepare the decoder for a new circuit
+            (e.g. building its cached objects in the `DecodingArtifacts`). When sampling in parallel,
+            idle worker processes only help out with problems whose decoders are cheap to set up.
+    """
+    name: str
+    decode: Callable[..., np.ndarray]
+    batch: bool = True
+    bit_packed: bool = False
+    correlated: bool = False
+    thread_safe: bool = False
+    setup_cost: str = "low"
+
+    def __post_init__(self):
+        if self.setup_cost not in ["low", "high"]:
+            raise ValueError(f"{self.setup_cost=!r}")
+
+
+_DECODERS: Dict[str, DecoderBackend] = {}
+
+
+def register_decoder(backend: DecoderBackend, *, replace: bool = False):
+    """Makes a decoder available by name.
+
+    Args:
+        backend: The decoder to register.
+        replace: Whether to replace an already registered decoder with the same name.
+
+    Raises:
+        ValueError: A decoder with the same name is already registered, and `replace` isn't set.
+    """
+    if backend.name in _DECODERS and not replace:
+        raise ValueError(f"A decoder named {backend.name!r} is already registered.")
+    _DECODERS[backend.name] = backend
+
+
+def unregister_decoder(name: str):
+    """Removes a registered decoder, e.g. one registered by a test.
+
+    Raises:
+        ValueError: No decoder with that name is registered.
+    """
+    if _DECODERS.pop(name, None) is None:
+        raise ValueError(f"No decoder named {name!r} is registered.")
+
+
+def get_decoder(name: str) -> DecoderBackend:
+    """Returns the registered decoder with the given name.
+
+    Raises:
+        NotImplementedError: No decoder with that name is registered.
+    """
+    backend = _DECODERS.get(name)
+    if backend is None:
+        raise NotImplementedError(f"decoder={name!r} isn't one of the registered decoders {registered_decoders()}.")
+    return backend
+
+
+def registered_decoders() -> List[str]:
+    """Returns the names of the registered decoders, in registration order."""
+    return list(_DECODERS.keys())
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import stim
+
+import decoding
+from decoder_registry import DecoderBackend, register_decoder, get_decoder, registered_decoders, unregister_decoder
+from decoding import sample_decode_count_shots_correct_per_decoder, DecodingArtifacts
+
+
+def _noisy_repetition_circuit() -> stim.Circuit:
+    return stim.Circuit.generated("repetition_code:memory", distance=3, rounds=3, before_round_data_depolarization=0.2)
+
+
+def test_builtin_decoders_are_registered():
+    names = registered_decoders()
+    for name in ["pymatching", "union_find", "lookup", "internal", "internal_correlated"]:
+        assert name in names
+    assert get_decoder("internal_correlated").correlated
+    assert not get_decoder("internal").correlated
+    assert get_decoder("pymatching").bit_packed
+
+
+def test_unknown_decoder():
+    with pytest.raises(NotImplementedError, match="not_a_decoder"):
+        get_decoder("not_a_decoder")
+    with pytest.raises(NotImplementedError):
+        decoding.sample_decode_count_correct(circuit=_noisy_repetition_circuit(), num_shots=10, decoder="not_a_decoder")
+
+
+def test_register_twice():
+    backend = DecoderBackend(name="test_register_twice", decode=lambda dets, *, artifacts: dets)
+    register_decoder(backend)
+    try:
+        with pytest.raises(ValueError, match="already registered"):
+            register_decoder(backend)
+        register_decoder(backend, replace=True)
+    finally:
+        unregister_decoder("test_register_twice")
+    assert "test_register_twice" not in registered_decoders()
+    with pytest.raises(ValueError, match="test_register_twice"):
+        unregister_decoder("test_register_twice")
+    with pytest.raises(ValueError):
+        DecoderBackend(name="bad", decode=lambda dets, *, artifacts: dets, setup_cost="medium")
+
+
+@pytest.mark.parametrize("batch,bit_packed,thread_safe", [
+    (False, False, False),
+    (True, False, True),
+    (False, True, False),
+    (True, True, True),
+])
+def test_registered_decoder_gets_its_data_path(batch: bool, bit_packed: bool, thread_safe: bool):
+    circuit = _noisy_repetition_circuit()
+    num_dets = circuit.num_detectors
+    seen_shapes = []
+
+    def decode(dets: np.ndarray, *, artifacts: DecodingArtifacts) -> np.ndarray:
+        seen_shapes.append((dets.shape, dets.dtype))
+        if bit_packed:
+            dets = np.unpackbits(dets, axis=-1, count=num_dets, bitorder='little')
+        # The matching graph has an extra boundary node after the detectors.
+        if batch:
+            predictions = np.array([artifacts.matching_graph.decode(np.append(d, 0)) for d in dets])
+        else:
+            predictions = artifacts.matching_graph.decode(np.append(dets, 0))
+        predictions = np.asarray(predictions, dtype=np.bool_)
+        if bit_packed:
+            predictions = np.packbits(predictions, axis=-1, bitorder='little')
+        return predictions
+
+    name = f"test_data_path_{batch}_{bit_packed}_{thread_safe}"
+    register_decoder(DecoderBackend(
+        name=name,
+        decode=decode,
+        batch=batch,
+        bit_packed=bit_packed,
+        thread_safe=thread_safe,
+    ))
+    try:
+        artifacts = DecodingArtifacts(circuit=circuit, syndrome_cache_size=0)
+        num_shots, (c1, c2) = sample_decode_count_shots_correct_per_decoder(
+            num_shots=50,
+            decoders=["pymatching", name],
+            artifacts=artifacts,
+        )
+    finally:
+        unregister_decoder(name)
+    assert num_shots == 50
+    assert c1 == c2
+    assert 0 < c1 < 50
+    det_width = (num_dets + 7) // 8 if bit_packed else num_dets
+    expected_shape = (50, det_width) if batch else (det_width,)
+    assert seen_shapes[0] == (expected_shape, np.uint8 if bit_packed else np.bool_)
+    assert len(seen_shapes) == (1 if batch else 50)
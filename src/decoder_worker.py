@@ -0,0 +1,177 @@
+"""This file contains a long-lived external decoder process that is fed batches of shots over pipes."""
+
+import atexit
+import os
+import select
+import subprocess
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+
+class DecoderWorker:
+    """Keeps an external decoder process running, and streams batches of shots through its pipes.
+
+    Starting an external decoder for every batch means re-parsing the error model and rebuilding
+    the decoding graph every batch, which dominates the runtime of small problems. A worker instead
+    starts the decoder once and reuses it: each batch's shots are written to the process's stdin,
+    and its predictions are read back from the process's stdout. The decoder must write one fixed
+    size row of prediction bytes per shot, and must flush its output after every shot (or at least
+    once it has consumed all the input it was given so far).
+
+    A separate thread writes the batch, so that a decoder which produces output before reading all
+    its input can't deadlock against a full pipe. Batches from different threads are decoded one at
+    a time.
+
+    If the process exits or closes its pipes in the middle of a batch, it is restarted and the
+    batch is retried, up to `max_restarts` times in a row. If the process instead stops producing
+    output for `read_timeout_seconds` (e.g. because it reads all of its input before writing any
+    predictions, and its input is never closed), it is killed and `TimeoutError` is raised, since
+    retrying would hang the same way. The process is shut down by `close` (also called when the
+    interpreter exits), by closing its stdin and waiting for it to exit.
+
+    Attributes:
+        num_starts: The number of times the process has been started.
+    """
+
+    def __init__(self,
+                 command: List[str],
+                 *,
+                 prediction_bytes_per_shot: int,
+                 max_restarts: int = 3,
+                 shutdown_timeout_seconds: float = 5,
+                 read_timeout_seconds: float = 60):
+        """
+        Args:
+            command: The command line that starts the decoder process.
+            prediction_bytes_per_shot: The size of the row of output written by the process per shot.
+            max_restarts: How many times to restart a crashed process before giving up on a batch.
+            shutdown_timeout_seconds: How long to wait for the process to exit after its stdin is
+                closed, before killing it.
+            read_timeout_seconds: How long to wait for more output from the process, while it owes
+                predictions for a batch, before killing it.
+        """
+        self.command = command
+        self.prediction_bytes_per_shot = prediction_bytes_per_shot
+        self.max_restarts = max_restarts
+        self.shutdown_timeout_seconds = shutdown_timeout_seconds
+        self.read_timeout_seconds = read_timeout_seconds
+        self.num_starts = 0
+        self._process: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def decode(self, shot_data: bytes, *, num_shots: int) -> np.ndarray:
+        """Sends a batch of shots to the process and returns its predictions.
+
+        Args:
+            shot_data: The encoded shots, in whatever format the process reads.
+            num_shots: The number of shots encoded in `shot_data`.
+
+        Returns:
+            A uint8 array with one row of `prediction_bytes_per_shot` bytes per shot.
+
+        Raises:
+            RuntimeError: The process kept crashing while decoding the batch.
+            TimeoutError: The process stopped producing output before finishing the batch.
+        """
+        expected = num_shots * self.prediction_bytes_per_shot
+        with self._lock:
+            for _ in range(self.max_restarts + 1):
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                result = self._exchange(shot_data, expected)
+                if result is not None:
+                    return np.frombuffer(result, dtype=np.uint8).reshape((num_shots, self.prediction_bytes_per_shot))
+                self._kill()
+        raise RuntimeError(f"The decoder process kept crashing. Command line is: {self.command}")
+
+    def close(self):
+        """Shuts down the process, if it is running."""
+        process = self._process
+        self._process = None
+        atexit.unregister(self.close)
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=self.shutdown_timeout_seconds)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def __enter__(self) -> 'DecoderWorker':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _start(self):
+        self._kill()
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.num_starts += 1
+
+    def _kill(self):
+        process = self._process
+        self._process = None
+        if process is None:
+            return
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        for pipe in [process.stdin, process.stdout]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _exchange(self, shot_data: bytes, expected: int) -> Optional[bytes]:
+        """Returns the process's output for the given input, or None if the process crashed."""
+        process = self._process
+        failed = []
+
+        def write():
+            try:
+                process.stdin.write(shot_data)
+                process.stdin.flush()
+            except OSError:
+                failed.append(True)
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        try:
+            result = self._read(process, expected)
+        except TimeoutError:
+            # Killing the process also unblocks the writer thread.
+            self._kill()
+            writer.join()
+            raise
+        except OSError:
+            result = b''
+        writer.join()
+        if failed or len(result) != expected:
+            return None
+        return result
+
+    def _read(self, process: subprocess.Popen, expected: int) -> bytes:
+        """Reads up to `expected` bytes from the process, stopping early at the end of its output."""
+        fd = process.stdout.fileno()
+        chunks = []
+        num_read = 0
+        while num_read < expected:
+            ready, _, _ = select.select([fd], [], [], self.read_timeout_seconds)
+            if not ready:
+                raise TimeoutError(
+                    f"The decoder process produced no output for {self.read_timeout_seconds} seconds, after "
+                    f"{num_read} of {expected} bytes. Command line is: {self.command}")
+            chunk = os.read(fd, expected - num_read)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            num_read += len(chunk)
+        return b''.join(chunks)
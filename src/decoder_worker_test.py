@@ -0,0 +1,66 @@
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from decoder_worker import DecoderWorker
+
+# Reads 2 byte shots and predicts the XOR of their bytes. Crashes the first time it sees a shot
+# starting with 255, if given a marker file to remember that it crashed.
+FAKE_DECODER = """
+import os, sys
+marker = sys.argv[1] if len(sys.argv) > 1 else None
+while True:
+    shot = sys.stdin.buffer.read(2)
+    if len(shot) < 2:
+        break
+    if marker is not None and shot[0] == 255 and not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    sys.stdout.buffer.write(bytes([shot[0] ^ shot[1]]))
+    sys.stdout.buffer.flush()
+"""
+
+
+def test_worker_is_reused_across_batches():
+    rng = np.random.default_rng(1)
+    with DecoderWorker([sys.executable, "-c", FAKE_DECODER], prediction_bytes_per_shot=1) as worker:
+        for num_shots in [0, 1, 5, 20000]:
+            shots = rng.integers(0, 255, size=(num_shots, 2), dtype=np.uint8)
+            predictions = worker.decode(shots.tobytes(), num_shots=num_shots)
+            np.testing.assert_array_equal(predictions[:, 0], shots[:, 0] ^ shots[:, 1])
+        assert worker.num_starts == 1
+        process = worker._process
+    assert process.returncode == 0
+    assert worker._process is None
+
+
+def test_worker_restarts_after_crash(tmp_path):
+    marker = str(tmp_path / "crashed")
+    with DecoderWorker([sys.executable, "-c", FAKE_DECODER, marker], prediction_bytes_per_shot=1) as worker:
+        shots = np.array([[1, 2], [255, 3], [4, 4]], dtype=np.uint8)
+        predictions = worker.decode(shots.tobytes(), num_shots=3)
+        np.testing.assert_array_equal(predictions[:, 0], [3, 252, 0])
+        assert worker.num_starts == 2
+
+
+def test_worker_gives_up_on_repeated_crashes():
+    with DecoderWorker([sys.executable, "-c", "pass"], prediction_bytes_per_shot=1, max_restarts=2) as worker:
+        with pytest.raises(RuntimeError, match="kept crashing"):
+            worker.decode(b"\x00\x00", num_shots=1)
+        assert worker.num_starts == 3
+
+
+def test_worker_times_out_on_decoder_that_reads_until_end_of_input():
+    # Only writes its predictions after its stdin is closed, which a worker never does mid-batch.
+    read_everything_first = "import sys; data = sys.stdin.buffer.read(); sys.stdout.buffer.write(data[::2])"
+    with DecoderWorker([sys.executable, "-c", read_everything_first],
+                       prediction_bytes_per_shot=1,
+                       read_timeout_seconds=0.5) as worker:
+        t0 = time.monotonic()
+        with pytest.raises(TimeoutError, match="no output"):
+            worker.decode(b"\x00\x00", num_shots=1)
+        assert time.monotonic() - t0 < 30
+        assert worker._process is None
+        assert worker.num_starts == 1
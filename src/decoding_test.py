@@ -1,13 +1,35 @@
+import functools
 import itertools
+import os
+import sys
+from typing import Optional
 import networkx as nx
-
+import numpy as np
+import pymatching
 import pytest
+import stim
 
-from decoding import sample_decode_count_correct, internal_decoder_path, detector_error_model_to_nx_graph
+from decoding import sample_decode_count_correct, internal_decoder_path, detector_error_model_to_nx_graph, \
+    DecodingArtifacts, iter_produced_in_background, decode_using_pymatching, sample_decode_count_shots_correct, \
+    sample_decode_count_shots_correct_per_decoder, PredictionCache, detector_error_model_to_edge_arrays, \
+    detector_error_model_to_pymatching_graph, pymatching_graph_from_edges, iter_flatten_model, flatten_model, \
+    write_detection_events, read_predictions, decode_using_internal_decoder, _SeededShotStream, encode_detection_events
+from decoder_worker import DecoderWorker
 from honeycomb_circuit import generate_honeycomb_circuit
 from honeycomb_layout import HoneycombLayout
 
 
+def _small_sd6_circuit(noise: float = 0.001) -> stim.Circuit:
+    return generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=10,
+        noise=noise,
+        style="SD6",
+        obs="V",
+    ))
+
+
 @pytest.mark.parametrize('tile_diam,sub_rounds,style,obs,decoder', itertools.product(
     range(1, 3),
     range(5, 10),
@@ -80,3 +102,623 @@ def test_graph_has_two_connected_components(style: str):
         for n, data in error_graph.nodes(data=True)
         if not data.get('is_boundary'))
     assert degree == (18 if style in ['EM3', 'EM3_v2'] else 12)
+
+
+def test_decoding_artifacts_reused_across_batches():
+    artifacts = DecodingArtifacts(circuit=_small_sd6_circuit())
+    matching_graph = artifacts.matching_graph
+    sampler = artifacts.sampler
+    for _ in range(3):
+        num_correct = sample_decode_count_correct(
+            num_shots=100,
+            artifacts=artifacts,
+            decoder="pymatching",
+        )
+        assert 0 <= num_correct <= 100
+    assert artifacts.matching_graph is matching_graph
+    assert artifacts.sampler is sampler
+
+
+def test_artifacts_made_for_a_single_call_are_closed(monkeypatch):
+    closed = []
+    original_close = DecodingArtifacts.close
+    monkeypatch.setattr(DecodingArtifacts, "close", lambda self: closed.append(self) or original_close(self))
+    circuit = _small_sd6_circuit()
+    sample_decode_count_correct(circuit=circuit, num_shots=10, decoder="pymatching")
+    assert len(closed) == 1
+    decode_using_pymatching(circuit, np.zeros((1, circuit.num_detectors), dtype=np.bool_), False)
+    assert len(closed) == 2
+
+
+def test_pipelined_sampling_and_decoding():
+    circuit = _small_sd6_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit)
+    num_correct = sample_decode_count_correct(
+        num_shots=1000,
+        artifacts=artifacts,
+        decoder="pymatching",
+        pipeline_chunk_size=300,
+    )
+    assert 700 <= num_correct <= 1000
+
+    # Seeded pipelined runs are reproducible.
+    a, b = [
+        sample_decode_count_correct(
+            num_shots=1000,
+            circuit=circuit,
+            decoder="pymatching",
+            seed=5,
+            pipeline_chunk_size=300,
+        )
+        for _ in range(2)
+    ]
+    assert a == b
+
+
+def test_iter_produced_in_background():
+    assert list(iter_produced_in_background(lambda e: e * 2, range(10))) == list(range(0, 20, 2))
+
+    def fail(e: int) -> int:
+        if e == 3:
+            raise ValueError("fail")
+        return e
+
+    seen = []
+    with pytest.raises(ValueError, match="fail"):
+        for e in iter_produced_in_background(fail, range(10)):
+            seen.append(e)
+    assert seen == [0, 1, 2]
+
+    # Stopping early doesn't leave the background thread hanging.
+    for e in iter_produced_in_background(lambda e: e, range(10)):
+        if e == 2:
+            break
+
+
+def test_bit_packed_decoding_matches_unpacked():
+    circuit = _small_sd6_circuit(noise=0.01)
+    dets, _ = circuit.compile_detector_sampler(seed=3).sample(200, separate_observables=True)
+    packed_dets = np.packbits(dets, axis=1, bitorder='little')
+    artifacts = DecodingArtifacts(circuit=circuit)
+    unpacked_predictions = decode_using_pymatching(
+        circuit=circuit,
+        det_samples=dets,
+        use_correlated_decoding=False,
+        artifacts=artifacts,
+    )
+    packed_predictions = decode_using_pymatching(
+        circuit=circuit,
+        det_samples=packed_dets,
+        use_correlated_decoding=False,
+        artifacts=artifacts,
+        bit_packed=True,
+    )
+    np.testing.assert_array_equal(
+        packed_predictions,
+        np.packbits(unpacked_predictions, axis=1, bitorder='little'),
+    )
+
+
+def test_max_sample_bytes_chunks_shots():
+    artifacts = DecodingArtifacts(circuit=_small_sd6_circuit())
+    num_correct = sample_decode_count_correct(
+        num_shots=1000,
+        artifacts=artifacts,
+        decoder="pymatching",
+        max_sample_bytes=artifacts.bytes_per_shot * 64,
+    )
+    assert 700 <= num_correct <= 1000
+
+
+def test_early_stop_skips_rest_of_batch():
+    artifacts = DecodingArtifacts(circuit=_small_sd6_circuit())
+    seen = []
+
+    def is_done(num_shots: int, num_correct: int) -> bool:
+        seen.append(num_shots)
+        return num_shots >= 300
+
+    num_shots, num_correct = sample_decode_count_shots_correct(
+        num_shots=1000,
+        artifacts=artifacts,
+        decoder="pymatching",
+        early_stop_chunk_size=100,
+        is_done=is_done,
+    )
+    assert num_shots == 300
+    assert seen == [100, 200, 300]
+    assert 200 <= num_correct <= 300
+
+    assert sample_decode_count_shots_correct(
+        num_shots=1000,
+        artifacts=artifacts,
+        decoder="pymatching",
+        early_stop_chunk_size=100,
+    )[0] == 1000
+
+
+def test_seeded_samples_dont_depend_on_chunking():
+    circuit = stim.Circuit.generated("repetition_code:memory", distance=5, rounds=5, before_round_data_depolarization=0.1)
+
+    def stream_samples(chunk_sizes):
+        stream = _SeededShotStream(circuit.compile_detector_sampler(seed=11), num_dets=circuit.num_detectors, num_obs=1)
+        chunks = [stream.sample(n) for n in chunk_sizes]
+        return np.concatenate([d for d, _ in chunks]), np.concatenate([o for _, o in chunks])
+
+    full_dets, full_obs = stream_samples([1000])
+    for chunk_sizes in [[100, 200, 700], [1, 999], [300, 300, 300, 100], [257, 743]]:
+        dets, obs = stream_samples(chunk_sizes)
+        np.testing.assert_array_equal(dets, full_dets)
+        np.testing.assert_array_equal(obs, full_obs)
+
+    # A seeded run gives the same counts however it's chunked, and an early stopped run is
+    # reproduced by re-running its processed number of shots with the same seed.
+    artifacts = DecodingArtifacts(circuit=circuit, syndrome_cache_size=0)
+    counts = {
+        sample_decode_count_correct(artifacts=artifacts, num_shots=1000, decoder="pymatching", seed=3, **kwargs)
+        for kwargs in [{}, {'pipeline_chunk_size': 300}, {'max_sample_bytes': artifacts.bytes_per_shot * 70}]
+    }
+    assert len(counts) == 1
+    num_shots, num_correct = sample_decode_count_shots_correct(
+        artifacts=artifacts,
+        num_shots=1000,
+        decoder="pymatching",
+        seed=3,
+        early_stop_chunk_size=130,
+        is_done=lambda n, c: n >= 390,
+    )
+    assert num_shots == 390
+    assert sample_decode_count_correct(artifacts=artifacts, num_shots=390, decoder="pymatching", seed=3) == num_correct
+
+
+def test_every_decoder_decodes_the_same_samples():
+    artifacts = DecodingArtifacts(circuit=_small_sd6_circuit())
+    decoders = ["pymatching", "pymatching"]
+    if internal_decoder_path() is not None:
+        decoders.append("internal")
+    num_shots, num_corrects = sample_decode_count_shots_correct_per_decoder(
+        num_shots=500,
+        artifacts=artifacts,
+        decoders=decoders,
+        seed=5,
+    )
+    assert num_shots == 500
+    assert len(num_corrects) == len(decoders)
+    assert num_corrects[0] == num_corrects[1]
+    assert num_corrects[0] == sample_decode_count_correct(
+        num_shots=500,
+        artifacts=artifacts,
+        decoder="pymatching",
+        seed=5,
+    )
+
+    with pytest.raises(NotImplementedError):
+        sample_decode_count_shots_correct_per_decoder(num_shots=1, artifacts=artifacts, decoders=["nope"])
+
+
+def test_decode_using_pymatching_matches_per_shot_decoding():
+    circuit = _small_sd6_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit)
+    # Enough shots to span several blocks.
+    dets = circuit.compile_detector_sampler(seed=3).sample(10000)
+    predictions = decode_using_pymatching(circuit, dets, False, artifacts=artifacts)
+    assert predictions.shape == (10000, circuit.num_observables)
+    for k in range(0, 10000, 97):
+        padded = np.zeros(circuit.num_detectors + 1, dtype=np.uint8)
+        padded[:-1] = dets[k]
+        np.testing.assert_array_equal(predictions[k], artifacts.matching_graph.decode(padded))
+
+
+def test_prediction_cache_decodes_each_syndrome_once():
+    cache = PredictionCache(max_size=2)
+    decoded = []
+
+    def decode(dets: np.ndarray) -> np.ndarray:
+        decoded.append(dets.copy())
+        return dets[:, :1] ^ 1
+
+    dets = np.array([[1, 2], [0, 0], [1, 2], [0, 0], [3, 3]], dtype=np.uint8)
+    np.testing.assert_array_equal(cache.predict(dets, decode), [[0], [1], [0], [1], [2]])
+    assert len(decoded) == 1 and len(decoded[0]) == 3
+    assert cache.num_shots == 5
+    assert cache.num_decoded == 3
+
+    # Only the two most recently used syndromes are remembered.
+    np.testing.assert_array_equal(cache.predict(dets[:3], decode), [[0], [1], [0]])
+    np.testing.assert_array_equal(decoded[1], [[0, 0]])
+    assert cache.num_decoded == 4
+    assert cache.hit_rate == 1 - 4 / 8
+
+
+def test_prediction_cache_skips_heavy_syndromes_and_stays_within_bytes():
+    cache = PredictionCache(max_size=100, max_bytes=1000, max_detection_events=2)
+    decoded = []
+
+    def decode(dets: np.ndarray) -> np.ndarray:
+        decoded.append(dets.copy())
+        return dets[:, :1]
+
+    # The heavy syndromes (3 and 16 detection events) are decoded every time and never cached.
+    dets = np.array([[7, 0], [255, 255], [1, 0], [7, 0], [1, 0]], dtype=np.uint8)
+    np.testing.assert_array_equal(cache.predict(dets, decode), [[7], [255], [1], [7], [1]])
+    np.testing.assert_array_equal(decoded[0], [[1, 0], [7, 0], [255, 255], [7, 0]])
+    np.testing.assert_array_equal(cache.predict(dets, decode), [[7], [255], [1], [7], [1]])
+    np.testing.assert_array_equal(decoded[1], [[7, 0], [255, 255], [7, 0]])
+    assert cache.num_decoded == 7
+
+    # Entries are evicted once they would use more than max_bytes.
+    rows = np.zeros((100, 2), dtype=np.uint8)
+    rows[:, 0] = np.arange(100) % 8
+    rows[:, 1] = np.arange(100) // 8
+    rows = np.unique(rows[np.unpackbits(rows, axis=1).sum(axis=1) <= 2], axis=0)
+    cache.predict(rows, decode)
+    assert 0 < cache.num_bytes <= 1000
+    assert len(cache._predictions) < len(rows)
+
+
+def test_prediction_cache_keeps_counts_unchanged():
+    circuit = _small_sd6_circuit()
+    cached = DecodingArtifacts(circuit=circuit)
+    uncached = DecodingArtifacts(circuit=circuit, syndrome_cache_size=0)
+    for _ in range(2):
+        a = sample_decode_count_correct(num_shots=1000, artifacts=cached, decoder="pymatching", seed=7)
+        b = sample_decode_count_correct(num_shots=1000, artifacts=uncached, decoder="pymatching", seed=7)
+        assert a == b
+    assert uncached.prediction_caches == {}
+    assert cached.prediction_caches["pymatching"].num_shots == 2000
+    assert cached.prediction_caches["pymatching"].hit_rate > 0.5
+
+
+def test_edge_arrays_match_nx_graph():
+    model = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=4,
+        data_height=6,
+        sub_rounds=20,
+        noise=0.001,
+        style="SD6",
+        obs="V",
+    )).detector_error_model(decompose_errors=True)
+    g = detector_error_model_to_nx_graph(model)
+    nodes1, nodes2, probabilities, masks = detector_error_model_to_edge_arrays(model)
+    assert len(nodes1) == g.number_of_edges()
+    for u, v, p, mask in zip(nodes1, nodes2, probabilities, masks):
+        data = g.get_edge_data(u, v)
+        assert data["error_probability"] == pytest.approx(p, rel=1e-9)
+        assert set(data["qubit_id"]) == {k for k in range(64) if int(mask) >> k & 1}
+
+
+def test_edge_arrays_merge_parallel_edges():
+    model = stim.DetectorErrorModel("""
+        error(0.1) D0 D1
+        error(0.2) D1 D0
+        error(0.3) D2 L0
+        error(0.25) D2
+        error(0.125) D2
+        error(0.01) D0 D1 L0
+    """)
+    nodes1, nodes2, probabilities, masks = detector_error_model_to_edge_arrays(model)
+    np.testing.assert_array_equal(nodes1, [0, 2])
+    np.testing.assert_array_equal(nodes2, [1, 3])
+    np.testing.assert_allclose(probabilities, [0.01, 0.25 * 0.875 + 0.75 * 0.125])
+    np.testing.assert_array_equal(masks, [1, 0])
+
+
+def test_pymatching_graph_decodes_like_nx_built_graph():
+    circuit = _small_sd6_circuit(noise=0.003)
+    model = circuit.detector_error_model(decompose_errors=True)
+    m = detector_error_model_to_pymatching_graph(model)
+    g = detector_error_model_to_nx_graph(model)
+    n = model.num_detectors
+    for k in range(n + 1):
+        g.add_edge(k, n + 1, weight=9999999999)
+    g.add_edge(n, n + 1, weight=9999999999, qubit_id=list(range(model.num_observables)))
+    expected = pymatching.Matching(g)
+    assert m.num_detectors == expected.num_detectors
+    assert m.boundary == expected.boundary
+
+    # Predictions can only differ where ties between equally weighted matchings are broken
+    # differently, so the weights are compared instead.
+    for shot in circuit.compile_detector_sampler(seed=5).sample(300):
+        z = np.zeros(n + 1, dtype=np.uint8)
+        z[:-1] = shot
+        _, actual_weight = m.decode(z, return_weight=True)
+        _, expected_weight = expected.decode(z, return_weight=True)
+        assert actual_weight == pytest.approx(expected_weight, rel=0, abs=1e-3)
+
+
+def _pymatching_graph_with_spandrel_fan(model: stim.DetectorErrorModel,
+                                        weights: Optional[np.ndarray] = None) -> pymatching.Matching:
+    """Builds the matching graph the old way, with an edge from every detector to the spandrel."""
+    n = model.num_detectors
+    nodes1, nodes2, probabilities, masks = detector_error_model_to_edge_arrays(model)
+    if weights is None:
+        weights = np.log((1 - probabilities) / probabilities)
+    m = pymatching.Matching()
+    for u, v, w, p, mask in zip(nodes1.tolist(), nodes2.tolist(), weights.tolist(), probabilities.tolist(),
+                                masks.tolist()):
+        m.add_edge(u, v, fault_ids={k for k in range(model.num_observables) if mask >> k & 1},
+                   weight=w, error_probability=p)
+    for k in range(n):
+        m.add_edge(k, n + 1, weight=9999999999)
+    m.add_edge(n, n + 1, weight=9999999999, fault_ids=set(range(model.num_observables)))
+    m.set_boundary_nodes({n})
+    return m
+
+
+@pytest.mark.parametrize('style', ["PC3", "SD6", "EM3_v2"])
+def test_pymatching_graph_only_bridges_unbounded_components(style: str):
+    circuit = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=4,
+        data_height=6,
+        sub_rounds=12,
+        noise=0.003,
+        style=style,
+        obs="V",
+    ))
+    model = circuit.detector_error_model(decompose_errors=True)
+    m = detector_error_model_to_pymatching_graph(model)
+    expected = _pymatching_graph_with_spandrel_fan(model)
+    n = model.num_detectors
+    assert m.num_detectors == expected.num_detectors
+    assert m.num_fault_ids == expected.num_fault_ids
+    assert m.boundary == expected.boundary
+
+    # At most one detector of each component without a boundary is bridged to the spandrel, and
+    # none of the component with the boundary.
+    nodes1, nodes2, probabilities, masks = detector_error_model_to_edge_arrays(model)
+    g = nx.Graph()
+    g.add_nodes_from(range(n + 1))
+    g.add_edges_from(zip(nodes1.tolist(), nodes2.tolist()))
+    spandrel_neighbors = set(m.to_networkx().neighbors(n + 1))
+    num_unbounded_components = 0
+    for component in nx.connected_components(g):
+        bridged = component & spandrel_neighbors
+        if n in component:
+            assert bridged == {n}
+        else:
+            assert len(bridged) == 1
+            num_unbounded_components += 1
+    expected_num_edges = expected.to_networkx().number_of_edges() - n + num_unbounded_components
+    assert m.to_networkx().number_of_edges() == expected_num_edges
+
+    # Shots sampled from the model decode the same as with the old graph. Tiny distinct weight
+    # offsets (the same in both graphs) make each shot's minimum weight matching unique, so that
+    # pymatching can't break ties differently in the two graphs.
+    weights = np.log((1 - probabilities) / probabilities)
+    weights += np.random.default_rng(5).uniform(0, 1e-4, size=len(weights))
+    m_jittered = pymatching_graph_from_edges(
+        nodes1=nodes1,
+        nodes2=nodes2,
+        weights=weights,
+        fault_ids=[{k for k in range(model.num_observables) if mask >> k & 1} for mask in masks.tolist()],
+        num_detectors=n,
+        error_probabilities=probabilities,
+        spandrel_fault_ids=set(range(model.num_observables)),
+    )
+    expected_jittered = _pymatching_graph_with_spandrel_fan(model, weights)
+    for shot in circuit.compile_detector_sampler(seed=5).sample(500):
+        z = np.zeros(n + 1, dtype=np.uint8)
+        z[:-1] = shot
+        _, actual_weight = m.decode(z, return_weight=True)
+        _, expected_weight = expected.decode(z, return_weight=True)
+        assert actual_weight == pytest.approx(expected_weight, rel=0, abs=1e-3)
+        np.testing.assert_array_equal(m_jittered.decode(z), expected_jittered.decode(z))
+
+    # A lone detection event, which the model can't produce in a component without a boundary, can
+    # still be matched.
+    for k in range(n):
+        z = np.zeros(n + 1, dtype=np.uint8)
+        z[k] = 1
+        m.decode(z)
+
+
+@pytest.mark.parametrize('style', ["PC3", "SD6", "EM3_v2"])
+def test_flatten_model_matches_stim_flattening(style: str):
+    model = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=20,
+        noise=0.001,
+        style=style,
+        obs="H",
+    )).detector_error_model(decompose_errors=True)
+    inner = model
+    model = stim.DetectorErrorModel("""
+        shift_detectors(0, 0, 5) 1
+        repeat 3 {
+    """ + str(inner) + """
+            shift_detectors(1.5) 2
+        }
+    """)
+
+    expected_errors = []
+    expected_coords = {}
+    for instruction in model.flattened():
+        if instruction.type == "error":
+            dets = []
+            frames = set()
+            for t in instruction.targets_copy() + [stim.target_separator()]:
+                if t.is_relative_detector_id():
+                    dets.append(t.val)
+                elif t.is_logical_observable_id():
+                    frames.add(t.val)
+                elif t.is_separator():
+                    expected_errors.append((instruction.args_copy()[0], dets, frames))
+                    dets = []
+                    frames = set()
+        elif instruction.type == "detector":
+            for t in instruction.targets_copy():
+                expected_coords[t.val] = instruction.args_copy()
+
+    actual_errors = []
+    actual_coords = {}
+    iter_flatten_model(
+        model,
+        handle_error=lambda p, dets, frames: actual_errors.append((p, dets, set(frames))),
+        handle_detector_coords=lambda det, coords: actual_coords.__setitem__(det, list(coords)),
+    )
+    assert actual_errors == expected_errors
+    assert actual_coords.keys() == expected_coords.keys()
+    for k, v in expected_coords.items():
+        np.testing.assert_allclose(actual_coords[k], v)
+
+    flat = flatten_model(model)
+    assert flat.det_shift == 1 + 3 * (flatten_model(inner).det_shift + 2)
+
+
+@pytest.mark.parametrize("fmt", ["b8", "r8", "dets"])
+def test_write_detection_events_matches_stim(fmt: str, tmp_path):
+    rng = np.random.default_rng(5)
+    num_dets = 600
+    det_samples = rng.random((40, num_dets)) < 0.01
+    det_samples[0] = False
+    det_samples[1] = True
+    det_samples[2, -1] = True
+    stim_path = str(tmp_path / "stim.out")
+    stim.write_shot_data_file(data=det_samples, path=stim_path, format=fmt, num_detectors=num_dets)
+    expected = open(stim_path, "rb").read()
+
+    for bit_packed in [False, True]:
+        data = np.packbits(det_samples, axis=1, bitorder='little') if bit_packed else det_samples
+        path = str(tmp_path / f"ours.{bit_packed}")
+        write_detection_events(path, data, num_dets=num_dets, bit_packed=bit_packed, fmt=fmt)
+        assert open(path, "rb").read() == expected
+
+    # An empty batch encodes like stim's empty file.
+    empty_path = str(tmp_path / "stim_empty.out")
+    stim.write_shot_data_file(data=det_samples[:0], path=empty_path, format=fmt, num_detectors=num_dets)
+    for bit_packed in [False, True]:
+        data = np.packbits(det_samples[:0], axis=1, bitorder='little') if bit_packed else det_samples[:0]
+        encoded = encode_detection_events(data, num_dets=num_dets, bit_packed=bit_packed, fmt=fmt)
+        assert encoded == open(empty_path, "rb").read() == b""
+
+
+@pytest.mark.parametrize("fmt", ["b8", "01"])
+def test_read_predictions_matches_stim(fmt: str, tmp_path):
+    rng = np.random.default_rng(6)
+    predictions = rng.random((30, 11)) < 0.5
+    path = str(tmp_path / "predictions")
+    stim.write_shot_data_file(data=predictions, path=path, format=fmt, num_observables=11)
+
+    actual = read_predictions(path, num_shots=30, num_obs=11, bit_packed=False, fmt=fmt)
+    np.testing.assert_array_equal(actual, predictions)
+    actual = read_predictions(path, num_shots=30, num_obs=11, bit_packed=True, fmt=fmt)
+    np.testing.assert_array_equal(actual, np.packbits(predictions, axis=1, bitorder='little'))
+
+
+def test_persistent_internal_decoder_is_started_once(tmp_path, monkeypatch):
+    # Stands in for the internal decoder, predicting that the observable flips for shots with an odd
+    # number of detection events.
+    fake_decoder = tmp_path / "fake_decoder"
+    fake_decoder.write_text(f"""#!{sys.executable}
+import sys
+assert sys.argv[sys.argv.index("-dets_fname") + 1] == "/dev/stdin"
+for line in sys.stdin:
+    sys.stdout.write(str(len(line.split()[1:]) % 2) + "\\n")
+    sys.stdout.flush()
+""")
+    os.chmod(fake_decoder, 0o755)
+    monkeypatch.setattr("decoding.internal_decoder_path", lambda: str(fake_decoder))
+
+    circuit = stim.Circuit("""
+        X_ERROR(0.3) 0 1
+        M 0 1
+        DETECTOR rec[-1]
+        DETECTOR rec[-2]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)
+    with DecodingArtifacts(circuit=circuit, persistent_internal_decoder=True) as artifacts:
+        for _ in range(3):
+            dets = artifacts.sampler.sample(100)
+            predictions = decode_using_internal_decoder(
+                circuit=circuit,
+                det_samples=dets,
+                use_correlated_decoding=False,
+                artifacts=artifacts,
+            )
+            np.testing.assert_array_equal(predictions[:, 0], np.count_nonzero(dets, axis=1) % 2 == 1)
+        (worker,) = artifacts.decoder_workers.values()
+        assert worker.num_starts == 1
+    assert not artifacts.decoder_workers
+    assert worker._process is None
+
+
+def test_persistent_internal_decoder_falls_back_when_it_doesnt_stream(tmp_path, monkeypatch):
+    # Reads all of its detection events before writing any predictions.
+    fake_decoder = tmp_path / "fake_decoder"
+    fake_decoder.write_text(f"""#!{sys.executable}
+import sys
+lines = open(sys.argv[sys.argv.index("-dets_fname") + 1]).read().splitlines()
+with open(sys.argv[sys.argv.index("-out") + 1], "w") as f:
+    for line in lines:
+        print(len(line.split()[1:]) % 2, file=f)
+""")
+    os.chmod(fake_decoder, 0o755)
+    monkeypatch.setattr("decoding.internal_decoder_path", lambda: str(fake_decoder))
+    monkeypatch.setattr("decoding.DecoderWorker", functools.partial(DecoderWorker, read_timeout_seconds=0.5))
+
+    circuit = stim.Circuit("""
+        X_ERROR(0.3) 0 1
+        M 0 1
+        DETECTOR rec[-1]
+        DETECTOR rec[-2]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)
+    with DecodingArtifacts(circuit=circuit, persistent_internal_decoder=True) as artifacts:
+        for _ in range(2):
+            dets = artifacts.sampler.sample(100)
+            predictions = decode_using_internal_decoder(circuit, dets, False, artifacts)
+            np.testing.assert_array_equal(predictions[:, 0], np.count_nonzero(dets, axis=1) % 2 == 1)
+        assert not artifacts.persistent_internal_decoder
+        (worker,) = artifacts.decoder_workers.values()
+        assert worker.num_starts == 1
+
+
+def test_persistent_internal_decoder_crash_writes_repro(tmp_path, monkeypatch):
+    fake_decoder = tmp_path / "fake_decoder"
+    fake_decoder.write_text(f"""#!{sys.executable}
+import sys
+sys.exit(1)
+""")
+    os.chmod(fake_decoder, 0o755)
+    monkeypatch.setattr("decoding.internal_decoder_path", lambda: str(fake_decoder))
+    monkeypatch.chdir(tmp_path)
+
+    circuit = stim.Circuit("""
+        X_ERROR(0.3) 0
+        M 0
+        DETECTOR rec[-1]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)
+    with DecodingArtifacts(circuit=circuit, persistent_internal_decoder=True) as artifacts:
+        with pytest.raises(RuntimeError, match="kept crashing"):
+            decode_using_internal_decoder(circuit, np.ones((1, 1), dtype=np.bool_), False, artifacts)
+    assert (tmp_path / "repro.dem").read_text().strip() == artifacts.error_model_text.strip()
+    assert (tmp_path / "repro.dets").read_text() == "shot D0\n"
+    assert stim.Circuit((tmp_path / "repro.stim").read_text()) == circuit
+
+
+def test_cached_external_decoder_decodes_the_same_samples_twice(tmp_path, monkeypatch):
+    fake_decoder = tmp_path / "fake_decoder"
+    fake_decoder.write_text(f"""#!{sys.executable}
+import sys
+for line in sys.stdin:
+    sys.stdout.write(str(len(line.split()[1:]) % 2) + "\\n")
+    sys.stdout.flush()
+""")
+    os.chmod(fake_decoder, 0o755)
+    monkeypatch.setattr("decoding.internal_decoder_path", lambda: str(fake_decoder))
+
+    circuit = stim.Circuit("""
+        X_ERROR(0.3) 0 1
+        M 0 1
+        DETECTOR rec[-1]
+        DETECTOR rec[-2]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)
+    with DecodingArtifacts(circuit=circuit, persistent_internal_decoder=True) as artifacts:
+        first = sample_decode_count_correct(num_shots=200, artifacts=artifacts, decoder="internal", seed=3)
+        # Every syndrome is cached by now, so the decoder isn't given anything to decode.
+        second = sample_decode_count_correct(num_shots=200, artifacts=artifacts, decoder="internal", seed=3)
+        assert first == second
+        assert artifacts.prediction_caches["internal"].num_decoded <= 4
@@ -0,0 +1,366 @@
+"""This file contains a decoder that looks up the syndromes of low weight errors in a precomputed table."""
+
+import os
+import pathlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+# Bumped when the saved table format changes, so that old tables aren't loaded.
+TABLE_FORMAT_VERSION = 2
+
+
+class LookupTableDecoder:
+    """Decodes syndromes by looking up the most likely observable flips of low weight errors.
+
+    The table is filled by enumerating every combination of up to `max_weight` errors from the
+    error model that is connected (each error shares a detector with another error in the
+    combination). For each syndrome that can be produced, the table holds the observable flips with
+    the largest total probability among the enumerated combinations producing it, along with that
+    total probability (as odds) and the fewest errors producing the syndrome.
+
+    Any combination of errors splits into connected pieces with disjoint syndromes, so the table
+    also covers combinations that aren't connected, without enumerating them. The detection events
+    of a shot are split into clusters, joining events that are at most `max_weight` errors apart
+    (so no connected piece spans two clusters), and each cluster is decoded separately. A cluster is
+    explained by the likeliest way of splitting it into syndromes from the table that uses at most
+    `max_weight` errors in total (a single table syndrome is one way). For example, two errors
+    flipping nearby but disjoint detectors are preferred over a less likely connected pair of
+    errors with the same syndrome, and errors far apart from each other are decoded
+    independently. Shots with a cluster that can't be explained are decoded by a fallback decoder.
+
+    Building the table is expensive, so tables can be saved to and loaded from disk (see
+    `load_or_build_lookup_table`).
+
+    Attributes:
+        num_detectors: The number of detectors in each syndrome.
+        num_observables: The number of observables predicted for each syndrome.
+        max_weight: The largest number of errors combined into each cluster's explanation.
+        syndromes: The bit packed (little endian) syndromes in the table, one row each.
+        observable_masks: The predicted observable flips of each syndrome, as bit masks.
+        odds: The total odds of the combinations producing each syndrome and its predicted flips.
+        weights: The fewest errors producing each syndrome.
+        num_lookups: The number of shots decoded so far.
+        num_misses: The number of those shots that were decoded by the fallback decoder.
+    """
+
+    def __init__(self,
+                 *,
+                 num_detectors: int,
+                 num_observables: int,
+                 max_weight: int,
+                 syndromes: np.ndarray,
+                 observable_masks: np.ndarray,
+                 odds: np.ndarray,
+                 weights: np.ndarray):
+        assert num_observables <= 64
+        self.num_detectors = num_detectors
+        self.num_observables = num_observables
+        self.max_weight = max_weight
+        self.syndromes = syndromes
+        self.observable_masks = observable_masks
+        self.odds = odds
+        self.weights = weights
+        self.num_lookups = 0
+        self.num_misses = 0
+
+        # The table is keyed by the (sorted) detectors of each syndrome.
+        keys = _syndrome_detectors(syndromes, num_detectors)
+        self._table: Dict[Tuple[int, ...], Tuple[float, int, int]] = dict(zip(
+            keys,
+            zip(odds.tolist(), weights.tolist(), observable_masks.tolist()),
+        ))
+        # The syndromes that can be part of a cluster's explanation, by their first detector.
+        self._pieces: Dict[int, List[Tuple[frozenset, float, int, int]]] = {}
+        for key, entry in self._table.items():
+            if key and entry[1] < max_weight:
+                self._pieces.setdefault(key[0], []).append((frozenset(key), *entry))
+        self._max_cluster_size = max_weight * max((len(key) for key in keys), default=0)
+
+        # Detection events this close to each other can be flipped by the same connected piece.
+        singles = [keys[k] for k in np.flatnonzero(weights == 1)]
+        incidence = scipy.sparse.csr_matrix(
+            (np.ones(sum(len(key) for key in singles), dtype=np.int64),
+             (np.repeat(np.arange(len(singles)), [len(key) for key in singles]),
+              np.array([d for key in singles for d in key], dtype=np.int64))),
+            shape=(len(singles), num_detectors),
+        )
+        step = ((incidence.T @ incidence) + scipy.sparse.identity(num_detectors, dtype=np.int64)).astype(np.bool_)
+        nearby = scipy.sparse.identity(num_detectors, dtype=np.bool_, format='csr')
+        for _ in range(max_weight):
+            nearby = nearby @ step
+        self._nearby = nearby.tocsr()
+
+    @staticmethod
+    def build(*,
+              probabilities: np.ndarray,
+              det_starts: np.ndarray,
+              dets: np.ndarray,
+              obs_masks: np.ndarray,
+              num_detectors: int,
+              num_observables: int,
+              max_weight: int = 2,
+              max_combinations: int = 2**24) -> 'LookupTableDecoder':
+        """Enumerates low weight error combinations into a table.
+
+        Args:
+            probabilities: The probability of each error.
+            det_starts: Error k flips the detectors `dets[det_starts[k]:det_starts[k + 1]]`.
+            dets: The detectors flipped by the errors, concatenated.
+            obs_masks: The observables flipped by each error, as bit masks.
+            num_detectors: The number of detectors.
+            num_observables: The number of observables.
+            max_weight: The largest number of errors to combine.
+            max_combinations: Enumeration stops early (at a lower weight, which becomes the table's
+                `max_weight`) instead of enumerating more than this many combinations of one weight.
+
+        The errors can be made by `decoding.flatten_model`, from an error model that wasn't
+        decomposed (each error is one combination of detectors).
+        """
+        num_errors = len(probabilities)
+        num_bytes = (num_detectors + 7) // 8
+        counts = np.diff(det_starts)
+        incidence = scipy.sparse.csr_matrix(
+            (np.ones(len(dets), dtype=np.int32), (np.repeat(np.arange(num_errors), counts), dets)),
+            shape=(num_errors, num_detectors),
+        )
+        # A detector flipped an even number of times by one error isn't flipped.
+        flips = (incidence.toarray() % 2).astype(np.bool_)
+        error_syndromes = np.packbits(flips, axis=1, bitorder='little')
+        adjacency = (incidence @ incidence.T).tocsr()
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        odds = probabilities / (1 - probabilities)
+        obs_masks = np.asarray(obs_masks, dtype=np.uint64)
+
+        all_syndromes = [np.zeros((1, num_bytes), dtype=np.uint8)]
+        all_masks = [np.zeros(1, dtype=np.uint64)]
+        all_odds = [np.ones(1)]
+        all_weights = [np.zeros(1, dtype=np.uint8)]
+        combos = np.arange(num_errors)[:, None]
+        built_weight = 0
+        for weight in range(1, max_weight + 1):
+            if weight > 1:
+                combos = _extend_connected_combinations(combos, adjacency, max_combinations)
+                if combos is None:
+                    break
+            built_weight = weight
+            all_syndromes.append(np.bitwise_xor.reduce(error_syndromes[combos], axis=1))
+            all_masks.append(np.bitwise_xor.reduce(obs_masks[combos], axis=1))
+            all_odds.append(np.prod(odds[combos], axis=1))
+            all_weights.append(np.full(len(combos), weight, dtype=np.uint8))
+        syndromes = np.concatenate(all_syndromes)
+        masks = np.concatenate(all_masks)
+        combo_odds = np.concatenate(all_odds)
+        combo_weights = np.concatenate(all_weights)
+
+        # Total the odds of each (syndrome, observable flips) pair, then keep the likeliest flips.
+        keys = np.concatenate([syndromes, masks.astype('<u8').view(np.uint8).reshape(-1, 8)], axis=1)
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        totals = np.bincount(inverse, weights=combo_odds)
+        key_weights = np.full(len(keys), 255, dtype=np.uint8)
+        np.minimum.at(key_weights, inverse, combo_weights)
+        syndromes = keys[:, :num_bytes]
+        masks = np.ascontiguousarray(keys[:, num_bytes:]).view('<u8').ravel()
+        order = np.lexsort((-totals, *syndromes.T[::-1]))
+        syndromes = syndromes[order]
+        first = np.ones(len(order), dtype=np.bool_)
+        first[1:] = np.any(syndromes[1:] != syndromes[:-1], axis=1)
+        return LookupTableDecoder(
+            num_detectors=num_detectors,
+            num_observables=num_observables,
+            max_weight=built_weight,
+            syndromes=np.ascontiguousarray(syndromes[first]),
+            observable_masks=masks[order][first].astype(np.uint64),
+            odds=totals[order][first],
+            weights=np.minimum.reduceat(key_weights[order], np.flatnonzero(first)),
+        )
+
+    def save(self, path: str):
+        """Writes the table to a `.npz` file, atomically replacing any existing file."""
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            num_detectors=self.num_detectors,
+            num_observables=self.num_observables,
+            max_weight=self.max_weight,
+            syndromes=self.syndromes,
+            observable_masks=self.observable_masks,
+            odds=self.odds,
+            weights=self.weights,
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'LookupTableDecoder':
+        with np.load(path) as data:
+            return LookupTableDecoder(
+                num_detectors=int(data["num_detectors"]),
+                num_observables=int(data["num_observables"]),
+                max_weight=int(data["max_weight"]),
+                syndromes=data["syndromes"],
+                observable_masks=data["observable_masks"],
+                odds=data["odds"],
+                weights=data["weights"],
+            )
+
+    @property
+    def miss_rate(self) -> float:
+        """The fraction of decoded shots that had to be decoded by the fallback decoder."""
+        if self.num_lookups == 0:
+            return 0
+        return self.num_misses / self.num_lookups
+
+    def decode(self,
+               det_samples: np.ndarray,
+               *,
+               fallback: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """Predicts the observable flips of bit packed syndromes.
+
+        Args:
+            det_samples: Bit packed (little endian) detection events, with one row per shot.
+            fallback: Decodes the bit packed rows that aren't in the table, returning bit packed
+                predictions.
+
+        Returns:
+            The bit packed predicted observable flips, with one row per shot.
+        """
+        num_shots = det_samples.shape[0]
+        rows = np.ascontiguousarray(det_samples, dtype=np.uint8)
+        masks = np.zeros(num_shots, dtype=np.uint64)
+        found = np.zeros(num_shots, dtype=np.bool_)
+        # Every detection event is paired with each nearby detector, so the number of shots decoded
+        # together is limited to keep those pairs to a few million.
+        chunk_size = max(1, 2**22 // max(1, self._nearby.nnz))
+        for start in range(0, num_shots, chunk_size):
+            stop = min(start + chunk_size, num_shots)
+            masks[start:stop], found[start:stop] = self._decode_masks(rows[start:stop])
+
+        self.num_lookups += num_shots
+        num_bytes = (self.num_observables + 7) // 8
+        predictions = np.ascontiguousarray(masks.astype('<u8').view(np.uint8).reshape((num_shots, 8))[:, :num_bytes])
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            self.num_misses += len(missing)
+            predictions[missing] = fallback(rows[missing])
+        return predictions
+
+    def _decode_masks(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the predicted observable flips of each shot (as bit masks), and whether each shot was explained."""
+        num_shots = rows.shape[0]
+        events = np.unpackbits(rows, axis=1, count=self.num_detectors, bitorder='little')
+        shots, dets = np.nonzero(events)
+        del events
+
+        # Join each detection event to the nearby detection events of the same shot.
+        sources, neighbors = _neighbors(self._nearby, dets)
+        event_keys = shots.astype(np.int64) * self.num_detectors + dets
+        neighbor_keys = shots[sources].astype(np.int64) * self.num_detectors + neighbors
+        targets = np.minimum(np.searchsorted(event_keys, neighbor_keys), max(len(event_keys) - 1, 0))
+        joined = event_keys[targets] == neighbor_keys
+        graph = scipy.sparse.coo_matrix(
+            (np.ones(np.count_nonzero(joined), dtype=np.int8), (sources[joined], targets[joined])),
+            shape=(len(dets), len(dets)),
+        )
+        _, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+        # Explain each cluster, keeping its detectors sorted.
+        order = np.argsort(labels, kind='stable')
+        starts = np.flatnonzero(np.diff(labels[order], prepend=-1) != 0)
+        stops = np.append(starts[1:], len(order)).tolist()
+        cluster_shots = shots[order][starts].tolist()
+        sorted_dets = dets[order].tolist()
+        masks = [0] * num_shots
+        found = [True] * num_shots
+        for shot, start, stop in zip(cluster_shots, starts.tolist(), stops):
+            if not found[shot]:
+                continue
+            explanation = self._explain(tuple(sorted_dets[start:stop]), self.max_weight)
+            if explanation is None:
+                found[shot] = False
+            else:
+                masks[shot] ^= explanation[1]
+        return np.array(masks, dtype=np.uint64), np.array(found, dtype=np.bool_)
+
+    def _explain(self, cluster: Tuple[int, ...], budget: int) -> Optional[Tuple[float, int]]:
+        """Returns the odds and observable flips of the likeliest explanation of a cluster.
+
+        The explanation splits the cluster into table syndromes produced by at most `budget` errors
+        in total. Returns None if there is no such explanation.
+        """
+        if not cluster:
+            return 1.0, 0
+        if len(cluster) > self._max_cluster_size:
+            return None
+        best = None
+        entry = self._table.get(cluster)
+        if entry is not None and entry[1] <= budget:
+            best = entry[0], entry[2]
+        cluster_set = None
+        for piece, odds, weight, mask in self._pieces.get(cluster[0], ()):
+            if weight >= budget or len(piece) >= len(cluster):
+                continue
+            if cluster_set is None:
+                cluster_set = frozenset(cluster)
+            if not piece <= cluster_set:
+                continue
+            rest = self._explain(tuple(d for d in cluster if d not in piece), budget - weight)
+            if rest is not None and (best is None or odds * rest[0] > best[0]):
+                best = odds * rest[0], mask ^ rest[1]
+        return best
+
+
+def _syndrome_detectors(syndromes: np.ndarray, num_detectors: int) -> List[Tuple[int, ...]]:
+    """Returns the sorted detectors of each bit packed syndrome."""
+    result = []
+    for start in range(0, len(syndromes), 2**16):
+        bits = np.unpackbits(syndromes[start:start + 2**16], axis=1, count=num_detectors, bitorder='little')
+        rows, dets = np.nonzero(bits)
+        bounds = np.searchsorted(rows, np.arange(len(bits) + 1)).tolist()
+        dets = dets.tolist()
+        result.extend(tuple(dets[a:b]) for a, b in zip(bounds[:-1], bounds[1:]))
+    return result
+
+
+def _neighbors(matrix: scipy.sparse.csr_matrix, members: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the (position in `members`, neighbor) pairs of the nonzero entries in the members' rows."""
+    degrees = np.diff(matrix.indptr)[members]
+    positions = np.repeat(np.arange(len(members)), degrees)
+    starts = np.repeat(matrix.indptr[members], degrees)
+    within = np.arange(len(positions)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    return positions, matrix.indices[starts + within]
+
+
+def _extend_connected_combinations(combos: np.ndarray,
+                                   adjacency: scipy.sparse.csr_matrix,
+                                   max_combinations: int):
+    """Adds one more error, adjacent to one of the combination's errors, to each combination.
+
+    Returns the distinct extended combinations (sorted within each row), or None if there would be
+    more than `max_combinations` of them.
+    """
+    degrees = np.diff(adjacency.indptr)
+    if int(np.sum(degrees[combos])) > 2 * max_combinations:
+        return None
+    extended = []
+    for column in range(combos.shape[1]):
+        rows, neighbors = _neighbors(adjacency, combos[:, column])
+        keep = np.all(combos[rows] != neighbors[:, None], axis=1)
+        extended.append(np.concatenate([combos[rows[keep]], neighbors[keep, None]], axis=1))
+    result = np.unique(np.sort(np.concatenate(extended), axis=1), axis=0)
+    if len(result) > max_combinations:
+        return None
+    return result
+
+
+def load_or_build_lookup_table(path: pathlib.Path, build: Callable[[], LookupTableDecoder]) -> LookupTableDecoder:
+    """Loads the table saved at `path`, or else builds it and saves it there."""
+    if path.exists():
+        return LookupTableDecoder.load(str(path))
+    result = build()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    result.save(str(path))
+    return result
@@ -0,0 +1,123 @@
+import numpy as np
+import stim
+
+from decoding import DecodingArtifacts, flatten_model, sample_decode_count_correct
+from lookup_decoding import LookupTableDecoder, load_or_build_lookup_table
+
+
+def _build(model: stim.DetectorErrorModel, max_weight: int) -> LookupTableDecoder:
+    flat = flatten_model(model)
+    return LookupTableDecoder.build(
+        probabilities=flat.probabilities,
+        det_starts=flat.det_starts,
+        dets=flat.dets,
+        obs_masks=flat.obs_masks,
+        num_detectors=model.num_detectors,
+        num_observables=model.num_observables,
+        max_weight=max_weight,
+    )
+
+
+def _packed(dets, num_detectors: int) -> np.ndarray:
+    row = np.zeros((1, num_detectors), dtype=np.bool_)
+    row[0, dets] = True
+    return np.packbits(row, axis=1, bitorder='little')
+
+
+def test_lookup_table_picks_likeliest_observable_flips():
+    model = stim.DetectorErrorModel("""
+        error(0.1) D0 L0
+        error(0.01) D0 D1
+        error(0.1) D1 D2
+        error(0.2) D2
+        error(0.001) D3
+        error(0.01) D4 D5
+    """)
+    decoder = _build(model, max_weight=2)
+
+    def fallback(rows: np.ndarray) -> np.ndarray:
+        return np.full((rows.shape[0], 1), 255, dtype=np.uint8)
+
+    cases = {
+        (): 0,
+        (0,): 1,
+        (0, 1): 0,  # D0 D1, rather than D0 L0 then D1 D2 then D2.
+        (1,): 0,  # D1 D2 then D2, vs D0 D1 then D0.
+        (0, 2): 1,  # D0 L0 and D2 aren't connected, but are likelier than D0 D1 then D1 D2.
+        (2,): 0,
+        (3,): 0,
+        (0, 3): 1,  # Far apart, so D0 and D3 are decoded separately.
+        (4, 5): 0,
+        (4,): 255,  # Can't be produced, so left to the fallback.
+        (0, 4): 255,  # One part can't be explained, so the whole shot is left to the fallback.
+    }
+    for dets, expected in cases.items():
+        actual = decoder.decode(_packed(list(dets), 6), fallback=fallback)
+        assert actual[0, 0] == expected, dets
+    assert decoder.num_lookups == len(cases)
+    assert decoder.num_misses == 2
+
+
+def test_lookup_table_decodes_batches_like_single_shots():
+    # A chain of detectors with boundaries at both ends. The left boundary edge flips observable 0.
+    model = stim.DetectorErrorModel("\n".join(
+        ["error(0.05) D0 L0", "error(0.05) D9"] + [f"error(0.02) D{k} D{k + 1}" for k in range(9)]))
+    decoder = _build(model, max_weight=2)
+
+    def fallback(rows: np.ndarray) -> np.ndarray:
+        return np.full((rows.shape[0], 1), 255, dtype=np.uint8)
+
+    rows = np.random.default_rng(1).random((200, 10)) < 0.2
+    batch = decoder.decode(np.packbits(rows, axis=1, bitorder='little'), fallback=fallback)
+    for row, actual in zip(rows, batch):
+        expected = decoder.decode(_packed(np.flatnonzero(row), 10), fallback=fallback)
+        np.testing.assert_array_equal(actual, expected[0])
+    assert 0 < decoder.num_misses < decoder.num_lookups
+
+
+def test_lookup_table_connected_combinations():
+    # A chain of 6 errors, each sharing a detector with the next one.
+    model = stim.DetectorErrorModel("\n".join(f"error(0.01) D{k} D{k + 1}" for k in range(6)))
+    sizes = [len(_build(model, max_weight=w).syndromes) for w in [1, 2, 3]]
+    # The empty syndrome, then 6 single errors, 5 adjacent pairs, and 4 adjacent triples.
+    assert sizes == [7, 12, 16]
+
+
+def test_lookup_table_is_saved_and_loaded(tmp_path):
+    model = stim.DetectorErrorModel("""
+        error(0.1) D0 L0
+        error(0.1) D0 D1
+    """)
+    path = tmp_path / "tables" / "table.npz"
+    num_builds = []
+
+    def build() -> LookupTableDecoder:
+        num_builds.append(1)
+        return _build(model, max_weight=2)
+
+    first = load_or_build_lookup_table(path, build)
+    second = load_or_build_lookup_table(path, build)
+    assert len(num_builds) == 1
+    np.testing.assert_array_equal(first.syndromes, second.syndromes)
+    np.testing.assert_array_equal(first.observable_masks, second.observable_masks)
+    np.testing.assert_array_equal(first.odds, second.odds)
+    np.testing.assert_array_equal(first.weights, second.weights)
+    assert second.max_weight == 2
+    assert second.num_detectors == 2
+    assert second.num_observables == 1
+
+
+def test_lookup_decoder_runs_by_name(tmp_path):
+    circuit = stim.Circuit.generated(
+        "surface_code:rotated_memory_x",
+        distance=3,
+        rounds=3,
+        after_clifford_depolarization=0.005,
+        before_measure_flip_probability=0.005,
+    )
+    artifacts = DecodingArtifacts(circuit=circuit, lookup_table_dir=str(tmp_path))
+    num_correct = sample_decode_count_correct(artifacts=artifacts, num_shots=3000, decoder="lookup", seed=2)
+    expected = sample_decode_count_correct(artifacts=artifacts, num_shots=3000, decoder="pymatching", seed=2)
+    assert abs(num_correct - expected) < 30
+    assert artifacts.lookup_decoder.miss_rate < 0.5
+    assert len(list(tmp_path.iterdir())) == 1
@@ -1,7 +1,7 @@
 import argparse
 import pathlib
 import sys
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import stim
 
@@ -22,6 +22,19 @@ def main():
     parser.add_argument('--max_shots', type=int, required=False)
     parser.add_argument('--max_errors', type=int, required=False)
     parser.add_argument('--max_batch_size', type=int, required=False)
+    parser.add_argument('--num_workers', type=int, required=False, help="Number of worker processes to sample with.")
+    parser.add_argument('--shard_log_file', type=str, required=False, help="Record the seeds of sharded batches here.")
+    parser.add_argument('--time_budget_seconds', type=float, required=False, help="Wall clock budget for the whole run.")
+    parser.add_argument('--target_batch_seconds', type=float, required=False, help="Size batches to take about this long.")
+    parser.add_argument('--max_batch_bytes', type=int, required=False, help="Memory ceiling for one batch of samples.")
+    parser.add_argument('--early_stop_chunk_size', type=int, required=False, help="Check the stopping rule every this many shots.")
+    parser.add_argument('--share_samples', action='store_true', help="Sample once for all decoders of a circuit.")
+    parser.add_argument('--archive_dir', type=str, required=False, help="Save the sampled shots into this directory.")
+    parser.add_argument('--persistent_internal_decoder', action='store_true', help="Keep the internal decoder running between batches.")
+    parser.add_argument('--lookup_table_dir', type=str, required=False, help="Save the lookup decoder's tables into this directory.")
+    parser.add_argument('--decoding_window', type=float, nargs=2, required=False, metavar=('COMMIT', 'BUFFER'), help="Window sizes of the pymatching_windowed decoder, in sub-rounds.")
+    parser.add_argument('--decoding_processes', type=int, required=False, help="Number of processes to decode each batch with.")
+    parser.add_argument('--decoders', type=str, nargs='+', required=False, help="Decoders to use instead of the defaults (e.g. union_find for pilot runs).")
     args = vars(parser.parse_args())
     out_path = args.get('out_file', None)
     problem_id = args.get('problem_id', None)
@@ -30,13 +43,39 @@ def main():
     surface_dir = args.get('surface_code_problems_directory')
     case_reduction = args.get('case_reduction') or 1
     max_batch_size = args.get('max_batch_size', None)
+    num_workers = args.get('num_workers') or 1
+    shard_log_path = args.get('shard_log_file', None)
+    time_budget_seconds = args.get('time_budget_seconds', None)
+    target_batch_seconds = args.get('target_batch_seconds', None)
+    max_batch_bytes = args.get('max_batch_bytes', None)
+    early_stop_chunk_size = args.get('early_stop_chunk_size', None)
+    share_samples = args.get('share_samples', False)
+    archive_dir = args.get('archive_dir', None)
+    persistent_internal_decoder = args.get('persistent_internal_decoder', False)
+    decoders = args.get('decoders') or DECODERS
+    lookup_table_dir = args.get('lookup_table_dir', None)
+    decoding_window = args.get('decoding_window', None)
+    decoding_processes = args.get('decoding_processes') or 1
     collect_data(surface_dir=surface_dir,
                  problem_id=problem_id,
                  case_reduction=case_reduction,
                  out_path=out_path,
                  max_shots=max_shots,
                  max_errors=max_errors,
-                 max_batch_size=max_batch_size)
+                 max_batch_size=max_batch_size,
+                 num_workers=num_workers,
+                 shard_log_path=shard_log_path,
+                 time_budget_seconds=time_budget_seconds,
+                 target_batch_seconds=target_batch_seconds,
+                 max_batch_bytes=max_batch_bytes,
+                 early_stop_chunk_size=early_stop_chunk_size,
+                 share_samples=share_samples,
+                 archive_dir=archive_dir,
+                 persistent_internal_decoder=persistent_internal_decoder,
+                 decoders=decoders,
+                 lookup_table_dir=lookup_table_dir,
+                 decoding_window=tuple(decoding_window) if decoding_window is not None else None,
+                 decoding_processes=decoding_processes)
 
 
 def collect_data(*,
@@ -46,10 +85,25 @@ def collect_data(*,
                  out_path: Optional[str],
                  max_shots: Optional[int] = None,
                  max_errors: Optional[int] = None,
-                 max_batch_size: Optional[int] = None):
+                 max_batch_size: Optional[int] = None,
+                 num_workers: int = 1,
+                 shard_log_path: Optional[str] = None,
+                 time_budget_seconds: Optional[float] = None,
+                 target_batch_seconds: Optional[float] = None,
+                 max_batch_bytes: Optional[int] = None,
+                 early_stop_chunk_size: Optional[int] = None,
+                 share_samples: bool = False,
+                 archive_dir: Optional[str] = None,
+                 persistent_internal_decoder: bool = False,
+                 decoders: Optional[List[str]] = None,
+                 lookup_table_dir: Optional[str] = None,
+                 decoding_window: Optional[Tuple[float, float]] = None,
+                 decoding_processes: int = 1):
     if surface_dir is None:
         surface_dir = f"{pathlib.Path(__file__).parent}/surface_code_circuits"
-    problems = honeycomb_problems() + surface_code_problems(surface_dir)
+    if decoders is None:
+        decoders = DECODERS
+    problems = honeycomb_problems(decoders) + surface_code_problems(surface_dir, decoders)
     print(f"Problems: {len(problems)}", file=sys.stderr)
     if problem_id is not None:
         print(f"Running problem #: {problem_id}", file=sys.stderr)
@@ -73,6 +127,18 @@ def collect_data(*,
         max_shots=max_shots if max_shots is not None else (10**8 // case_reduction),
         max_sample_std_dev=1,
         min_seen_logical_errors=max_errors if max_errors is not None else (10**3 // case_reduction),
+        num_workers=num_workers,
+        shard_log_path=shard_log_path,
+        time_budget_seconds=time_budget_seconds,
+        target_batch_seconds=target_batch_seconds,
+        max_batch_bytes=max_batch_bytes,
+        early_stop_chunk_size=early_stop_chunk_size,
+        share_samples=share_samples,
+        archive_dir=archive_dir,
+        persistent_internal_decoder=persistent_internal_decoder,
+        lookup_table_dir=lookup_table_dir,
+        decoding_window=decoding_window,
+        decoding_processes=decoding_processes,
     )
 
 
@@ -118,7 +184,7 @@ def surface_code_problem(directory: str,
     )
 
 
-def surface_code_problems(directory: Optional[str]) -> List[DecodingProblem]:
+def surface_code_problems(directory: Optional[str], decoders: List[str]) -> List[DecodingProblem]:
     if directory in ["-", "", None]:
         return []
 
@@ -131,7 +197,7 @@ def surface_code_problems(directory: Optional[str]) -> List[DecodingProblem]:
             obs=obs,
             decoder=decoder,
         )
-        for decoder in DECODERS
+        for decoder in decoders
         for d in [3, 7, 11, 15, 19]
         for p in USED_NOISE_VALUES
         for noise_name in ["SD6", "SI1000"]
@@ -160,7 +226,7 @@ DECODERS = [
     "internal_correlated",
 ]
 
-def honeycomb_problems() -> List[DecodingProblem]:
+def honeycomb_problems(decoders: List[str]) -> List[DecodingProblem]:
     layouts: List[HoneycombLayout] = [
         HoneycombLayout(
             noise=p,
@@ -190,7 +256,7 @@ def honeycomb_problems() -> List[DecodingProblem]:
     ]
     return [
         lay.as_decoder_problem(decoder)
-        for decoder in DECODERS
+        for decoder in decoders
         for lay in layouts
     ]
 
@@ -0,0 +1,27 @@
+import argparse
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))  # Non-package import directory hack.
+
+from collect_data import decode_archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode previously sampled shots saved by main_collect_all.py.")
+    parser.add_argument('archive_paths', type=str, nargs='+', help="Archive directories to decode.")
+    parser.add_argument('--decoders', type=str, nargs='+', required=True, help="The decoders to use.")
+    parser.add_argument('--out_file', type=str, required=False, help="Write to a file in addition to stdout.")
+    parser.add_argument('--chunk_size', type=int, default=2**14, help="Shots to load from disk at a time.")
+    args = parser.parse_args()
+    for archive_path in args.archive_paths:
+        decode_archive(
+            archive_path,
+            decoders=args.decoders,
+            out_path=args.out_file,
+            chunk_size=args.chunk_size,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""This file contains a pool of worker processes that decode the shots of one batch together."""
+
+import atexit
+import collections
+import concurrent.futures
+import dataclasses
+import math
+import multiprocessing
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Optional
+
+import numpy as np
+import stim
+
+from decoder_registry import DecoderBackend, get_decoder, registered_decoders
+from decoding import DecodingArtifacts, decode_bit_packed
+
+
+class DecodingPool:
+    """Decodes a batch of shots by splitting it into ranges of shots across worker processes.
+
+    The bit packed detection events of the batch are copied into a block of shared memory, and each
+    worker is told which range of shots to decode. The workers read their shots from the shared
+    block and write their predictions into a second shared block, so the only data sent through
+    pipes is the task description. The blocks are kept and reused by later batches (growing them
+    when a batch doesn't fit).
+
+    Each worker keeps the `DecodingArtifacts` of the problems it has recently decoded, keyed by
+    their `problem_key`, so a worker builds a problem's matching graph (or other decoder objects)
+    once, on the first batch it sees, instead of once per batch. The circuit is only sent to a
+    worker after it reports not having the problem. Decoders registered after the pool was made
+    are sent along with each task, so they must be picklable (e.g. defined at module level).
+    Decoder statistics (e.g. the "lookup" decoder's miss rate) are collected inside the workers and
+    aren't visible from the calling process.
+
+    The workers are started when the pool is made and stay running until `close` is called (which
+    also happens when the interpreter exits), so one pool can be reused across batches and problems.
+    Uses the fork start method, like `collect_data`. Forking a process while other threads are
+    running can deadlock the child (e.g. when another thread holds a lock the child needs), so the
+    pool should be made before starting any threads, such as those of
+    `sample_decode_count_shots_correct_per_decoder`. `decode` itself can be called from any thread.
+
+    Attributes:
+        num_workers: The number of worker processes.
+        min_shots_per_task: Batches are split into ranges of at least this many shots. Batches too
+            small to be split are decoded in the calling process.
+        max_cached_problems: The number of problems whose decoder objects each worker keeps.
+    """
+
+    def __init__(self, *, num_workers: int, min_shots_per_task: int = 256, max_cached_problems: int = 2):
+        assert num_workers >= 1
+        assert min_shots_per_task >= 1
+        self.num_workers = num_workers
+        self.min_shots_per_task = min_shots_per_task
+        self.max_cached_problems = max_cached_problems
+        self._blocks: Dict[str, shared_memory.SharedMemory] = {}
+        self._lock = threading.Lock()
+        # The decoders that the forked workers can find in their copy of the registry.
+        self._forked_backends = {name: get_decoder(name) for name in registered_decoders()}
+        # Started before forking, so that the workers share the resource tracker that owns the shared
+        # memory blocks instead of starting their own.
+        resource_tracker.ensure_running()
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = concurrent.futures.ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+        # The executor forks its workers when the first tasks are submitted, so they're forked now
+        # instead of from whichever thread first calls `decode`.
+        for future in [self._executor.submit(_start_worker) for _ in range(num_workers)]:
+            future.result()
+        atexit.register(self.close)
+
+    def decode(self, det_samples: np.ndarray, *, decoder: str, artifacts: DecodingArtifacts) -> np.ndarray:
+        """Decodes bit packed detection events, like `decoding.decode_bit_packed`.
+
+        Args:
+            det_samples: Bit packed detection events, with one row per shot.
+            decoder: The name of the decoder to use.
+            artifacts: The error model and decoder objects of the circuit the samples came from. Only
+                used directly when the batch is too small to be split. Otherwise its `problem_key`
+                tells the workers which of their decoder objects to use.
+
+        Returns:
+            The bit packed predicted observable flips, with one row per shot.
+        """
+        num_shots, det_width = det_samples.shape
+        num_tasks = min(self.num_workers, num_shots // self.min_shots_per_task)
+        if num_tasks <= 1:
+            return decode_bit_packed(get_decoder(decoder), det_samples, artifacts=artifacts)
+        prediction_width = (artifacts.model_circuit.num_observables + 7) // 8
+        backend = get_decoder(decoder)
+        # Decoders registered (or replaced) after the workers were forked are sent along with the task.
+        late_backend = None if self._forked_backends.get(decoder) is backend else backend
+
+        with self._lock:
+            if self._executor is None:
+                raise ValueError("The pool is closed.")
+            dets_block = self._block("dets", max(1, det_samples.nbytes))
+            predictions_block = self._block("predictions", max(1, num_shots * prediction_width))
+            np.ndarray(det_samples.shape, dtype=np.uint8, buffer=dets_block.buf)[:] = det_samples
+
+            def submit(start: int, stop: int, with_circuit: bool) -> concurrent.futures.Future:
+                return self._executor.submit(_decode_shot_range, _ShotRangeTask(
+                    problem_key=artifacts.problem_key,
+                    circuit=artifacts.model_circuit if with_circuit else None,
+                    artifacts_kwargs=_artifacts_kwargs(artifacts) if with_circuit else None,
+                    max_cached_problems=self.max_cached_problems,
+                    decoder=decoder,
+                    backend=late_backend,
+                    dets_name=dets_block.name,
+                    predictions_name=predictions_block.name,
+                    num_shots=num_shots,
+                    det_width=det_width,
+                    prediction_width=prediction_width,
+                    start=start,
+                    stop=stop,
+                ))
+
+            # The circuit is only sent to the workers that report not having the problem's decoder
+            # objects, instead of being pickled into every task of every batch.
+            bounds = np.linspace(0, num_shots, num_tasks + 1).astype(np.int64).tolist()
+            ranges = list(zip(bounds[:-1], bounds[1:]))
+            futures = [submit(start, stop, with_circuit=False) for start, stop in ranges]
+            retries = [
+                submit(start, stop, with_circuit=True)
+                for (start, stop), future in zip(ranges, futures)
+                if not future.result()
+            ]
+            for future in retries:
+                assert future.result()
+            return np.ndarray((num_shots, prediction_width), dtype=np.uint8, buffer=predictions_block.buf).copy()
+
+    def _block(self, purpose: str, size: int) -> shared_memory.SharedMemory:
+        """Returns a shared memory block of at least the given size, reusing the previous one if possible."""
+        block = self._blocks.get(purpose)
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            # Grow geometrically, so that slowly growing batches don't reallocate every time.
+            capacity = 1 << math.ceil(math.log2(size))
+            block = shared_memory.SharedMemory(create=True, size=capacity)
+            self._blocks[purpose] = block
+        return block
+
+    def close(self):
+        """Shuts down the worker processes and frees the shared memory."""
+        atexit.unregister(self.close)
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            for block in self._blocks.values():
+                block.close()
+                block.unlink()
+            self._blocks.clear()
+
+    def __enter__(self) -> 'DecodingPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@dataclasses.dataclass
+class _ShotRangeTask:
+    problem_key: str
+    circuit: Optional[stim.Circuit]
+    artifacts_kwargs: Optional[Dict[str, Any]]
+    max_cached_problems: int
+    decoder: str
+    backend: Optional[DecoderBackend]
+    dets_name: str
+    predictions_name: str
+    num_shots: int
+    det_width: int
+    prediction_width: int
+    start: int
+    stop: int
+
+
+def _artifacts_kwargs(artifacts: DecodingArtifacts) -> Dict[str, Any]:
+    """The settings that the workers' artifacts need to decode like the given artifacts.
+
+    The workers don't keep prediction caches, since the calling process already has them.
+    """
+    return {
+        'syndrome_cache_size': 0,
+        'persistent_internal_decoder': artifacts.persistent_internal_decoder,
+        'lookup_table_dir': artifacts.lookup_table_dir,
+        'lookup_max_weight': artifacts.lookup_max_weight,
+        'decoding_window': artifacts.decoding_window,
+    }
+
+
+# The decoder objects of the problems recently decoded by this worker process, oldest first.
+_worker_artifacts: 'collections.OrderedDict[str, DecodingArtifacts]' = collections.OrderedDict()
+
+
+def _start_worker():
+    pass
+
+
+def _decode_shot_range(task: _ShotRangeTask) -> bool:
+    """Decodes the task's range of shots, or returns False if the task needs to include the circuit."""
+    artifacts = _worker_artifacts.get(task.problem_key)
+    if artifacts is None:
+        if task.circuit is None:
+            return False
+        artifacts = DecodingArtifacts(circuit=task.circuit, **task.artifacts_kwargs)
+        _worker_artifacts[task.problem_key] = artifacts
+        while len(_worker_artifacts) > task.max_cached_problems:
+            _, evicted = _worker_artifacts.popitem(last=False)
+            evicted.close()
+    else:
+        _worker_artifacts.move_to_end(task.problem_key)
+
+    dets_block = shared_memory.SharedMemory(name=task.dets_name)
+    predictions_block = shared_memory.SharedMemory(name=task.predictions_name)
+    try:
+        dets = np.ndarray((task.num_shots, task.det_width), dtype=np.uint8, buffer=dets_block.buf)
+        predictions = np.ndarray((task.num_shots, task.prediction_width), dtype=np.uint8, buffer=predictions_block.buf)
+        predictions[task.start:task.stop] = decode_bit_packed(
+            get_decoder(task.decoder) if task.backend is None else task.backend,
+            np.array(dets[task.start:task.stop]),
+            artifacts=artifacts,
+        )
+        del dets, predictions
+    finally:
+        dets_block.close()
+        predictions_block.close()
+    return True
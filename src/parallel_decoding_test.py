@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import pathlib
+import threading
+
+import numpy as np
+import stim
+
+from decoder_registry import DecoderBackend, register_decoder, get_decoder, unregister_decoder
+from decoding import DecodingArtifacts, decode_bit_packed, sample_decode_count_correct
+from parallel_decoding import DecodingPool, _decode_shot_range, _ShotRangeTask
+
+
+def _surface_code_circuit() -> stim.Circuit:
+    return stim.Circuit.generated(
+        "surface_code:rotated_memory_x",
+        distance=3,
+        rounds=3,
+        after_clifford_depolarization=0.02,
+        before_measure_flip_probability=0.02,
+    )
+
+
+def _register_logged_decoder(name: str, log_path: pathlib.Path):
+    """Registers a decoder that logs the process, artifacts and number of shots of each call."""
+    def decode(dets: np.ndarray, *, artifacts: DecodingArtifacts) -> np.ndarray:
+        with open(log_path, "a") as f:
+            print(os.getpid(), id(artifacts), dets.shape[0], file=f)
+        return np.zeros((dets.shape[0], 1), dtype=np.uint8)
+
+    register_decoder(DecoderBackend(name=name, decode=decode, bit_packed=True))
+
+
+def _decode_all_flipped(dets: np.ndarray, *, artifacts: DecodingArtifacts) -> np.ndarray:
+    return np.ones((dets.shape[0], 1), dtype=np.uint8)
+
+
+def test_pool_starts_its_workers_eagerly():
+    before = len(multiprocessing.active_children())
+    with DecodingPool(num_workers=3) as pool:
+        assert len(multiprocessing.active_children()) == before + 3
+        # Decoding from another thread doesn't fork.
+        circuit = _surface_code_circuit()
+        artifacts = DecodingArtifacts(circuit=circuit)
+        dets = circuit.compile_detector_sampler(seed=1).sample(1000, bit_packed=True)
+        results = []
+
+        def decode():
+            results.append(pool.decode(dets, decoder="pymatching", artifacts=artifacts))
+
+        thread = threading.Thread(target=decode)
+        thread.start()
+        thread.join()
+        assert len(multiprocessing.active_children()) == before + 3
+        expected = decode_bit_packed(get_decoder("pymatching"), dets, artifacts=artifacts)
+        np.testing.assert_array_equal(results[0], expected)
+
+
+def test_pool_decodes_like_calling_process():
+    circuit = _surface_code_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit)
+    with DecodingPool(num_workers=3, min_shots_per_task=100) as pool:
+        for seed in range(3):
+            dets, _ = circuit.compile_detector_sampler(seed=seed).sample(1000, separate_observables=True, bit_packed=True)
+            expected = decode_bit_packed(get_decoder("pymatching"), dets, artifacts=artifacts)
+            np.testing.assert_array_equal(pool.decode(dets, decoder="pymatching", artifacts=artifacts), expected)
+
+
+def test_pool_workers_keep_their_decoder_objects(tmp_path):
+    circuit = _surface_code_circuit()
+    log_path = tmp_path / "calls.txt"
+    _register_logged_decoder("test_pool_logged", log_path)
+    try:
+        artifacts = DecodingArtifacts(circuit=circuit)
+        with DecodingPool(num_workers=2, min_shots_per_task=10) as pool:
+            for _ in range(4):
+                dets = np.zeros((100, (circuit.num_detectors + 7) // 8), dtype=np.uint8)
+                pool.decode(dets, decoder="test_pool_logged", artifacts=artifacts)
+    finally:
+        unregister_decoder("test_pool_logged")
+
+    calls = [line.split() for line in log_path.read_text().splitlines()]
+    assert sum(int(num_shots) for _, _, num_shots in calls) == 400
+    assert all(pid != str(os.getpid()) for pid, _, _ in calls)
+    # Each worker made the problem's artifacts once, and reused them for every later batch.
+    artifacts_ids_per_pid = {}
+    for pid, artifacts_id, _ in calls:
+        artifacts_ids_per_pid.setdefault(pid, set()).add(artifacts_id)
+    assert all(len(ids) == 1 for ids in artifacts_ids_per_pid.values())
+
+
+def test_pool_decodes_small_batches_in_calling_process(tmp_path):
+    circuit = _surface_code_circuit()
+    log_path = tmp_path / "calls.txt"
+    _register_logged_decoder("test_pool_small_batches", log_path)
+    try:
+        artifacts = DecodingArtifacts(circuit=circuit)
+        with DecodingPool(num_workers=4, min_shots_per_task=1000) as pool:
+            dets = np.zeros((1500, (circuit.num_detectors + 7) // 8), dtype=np.uint8)
+            pool.decode(dets, decoder="test_pool_small_batches", artifacts=artifacts)
+    finally:
+        unregister_decoder("test_pool_small_batches")
+    assert [line.split()[0] for line in log_path.read_text().splitlines()] == [str(os.getpid())]
+
+
+def test_sample_decode_count_correct_with_pool():
+    circuit = _surface_code_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit, syndrome_cache_size=0)
+    expected = sample_decode_count_correct(artifacts=artifacts, num_shots=2000, decoder="pymatching", seed=5)
+    with DecodingPool(num_workers=2, min_shots_per_task=100) as pool:
+        actual = sample_decode_count_correct(
+            artifacts=artifacts,
+            num_shots=2000,
+            decoder="pymatching",
+            seed=5,
+            decoding_pool=pool,
+        )
+    assert actual == expected
+    assert 0 < actual < 2000
+
+
+def test_pool_uses_decoders_registered_after_it_was_made():
+    circuit = _surface_code_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit)
+    dets = np.zeros((1000, (circuit.num_detectors + 7) // 8), dtype=np.uint8)
+    with DecodingPool(num_workers=2, min_shots_per_task=100) as pool:
+        register_decoder(DecoderBackend(name="test_pool_late", decode=_decode_all_flipped, bit_packed=True))
+        try:
+            predictions = pool.decode(dets, decoder="test_pool_late", artifacts=artifacts)
+        finally:
+            unregister_decoder("test_pool_late")
+    np.testing.assert_array_equal(predictions, np.ones((1000, 1), dtype=np.uint8))
+
+
+def test_shot_range_without_circuit_asks_for_it():
+    circuit = _surface_code_circuit()
+    artifacts = DecodingArtifacts(circuit=circuit)
+    task = _ShotRangeTask(
+        problem_key=artifacts.problem_key,
+        circuit=None,
+        artifacts_kwargs=None,
+        max_cached_problems=2,
+        decoder="pymatching",
+        backend=None,
+        dets_name="unused",
+        predictions_name="unused",
+        num_shots=0,
+        det_width=0,
+        prediction_width=0,
+        start=0,
+        stop=0,
+    )
+    assert not _decode_shot_range(task)
@@ -0,0 +1,176 @@
+"""This file contains a buffered writer for appending CSV records to a shared results file."""
+
+import atexit
+import os
+import signal
+import threading
+import weakref
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows. Appends from separate processes may interleave there.
+
+
+class RecordWriter:
+    """Appends lines to a results file, keeping it open and buffering lines between flushes.
+
+    Buffered lines are flushed when `max_buffered_records` lines are waiting, when the oldest
+    waiting line is `max_buffer_seconds` old, when the writer is closed, when the interpreter
+    exits, and when the process receives SIGTERM (which skips the exit handlers) before the signal
+    is passed on to the previous handler. Nothing can flush on SIGKILL, so callers that can't
+    afford to lose lines should also `flush` at natural checkpoints. A flush writes every buffered
+    line using one append to a file descriptor opened in append mode, while holding an exclusive
+    lock on the file. Several writers (e.g. in separate processes) can therefore target the same
+    file without their lines interleaving.
+
+    Lines are also echoed to stdout as soon as they are written, if requested.
+    """
+
+    def __init__(self,
+                 out_path: Optional[str],
+                 *,
+                 header: Optional[str] = None,
+                 discard_previous_data: bool = False,
+                 echo: bool = True,
+                 max_buffered_records: int = 64,
+                 max_buffer_seconds: float = 10):
+        """
+        Args:
+            out_path: The file to append to. Setting this to None doesn't write to file; only echoes
+                to stdout.
+            header: A line to write at the start of the file, if the file is new or empty.
+            discard_previous_data: If set, the file's existing contents are deleted.
+            echo: Whether written lines are also printed to stdout.
+            max_buffered_records: Flush once this many lines are waiting to be written.
+            max_buffer_seconds: Flush once a line has been waiting this long.
+        """
+        self.out_path = out_path
+        self.echo = echo
+        self.max_buffered_records = max_buffered_records
+        self.max_buffer_seconds = max_buffer_seconds
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._fd: Optional[int] = None
+
+        if out_path is not None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+            if discard_previous_data:
+                flags |= os.O_TRUNC
+            self._fd = os.open(out_path, flags, 0o644)
+            if header is not None:
+                with self._locked_file():
+                    if os.fstat(self._fd).st_size == 0:
+                        self._write_all(header + "\n")
+            self._pid = os.getpid()
+            _open_writers.add(self)
+            _install_sigterm_handler()
+            atexit.register(self.close)
+
+    def write(self, line: str):
+        if self.echo:
+            print(line, flush=True)
+        if self._fd is None:
+            return
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.max_buffered_records:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_buffer_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        if self._fd is None:
+            return
+        self.flush()
+        os.close(self._fd)
+        self._fd = None
+        atexit.unregister(self.close)
+
+    def _flush_on_signal(self):
+        # The signal can arrive while this thread holds the lock, in which case the lines are lost
+        # instead of deadlocking.
+        if self._pid != os.getpid() or not self._lock.acquire(timeout=1):
+            return
+        try:
+            self._flush_locked()
+        finally:
+            self._lock.release()
+
+    def __enter__(self) -> 'RecordWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer or self._fd is None:
+            return
+        text = "".join(line + "\n" for line in self._buffer)
+        with self._locked_file():
+            self._write_all(text)
+        self._buffer.clear()
+
+    def _locked_file(self) -> 'FileLock':
+        return FileLock(self._fd)
+
+    def _write_all(self, text: str):
+        data = text.encode()
+        while data:
+            n = os.write(self._fd, data)
+            data = data[n:]
+
+
+# The writers with an open file, flushed when the process receives SIGTERM. Writers inherited by a
+# forked child aren't flushed by the child (see `_flush_on_signal`), so lines aren't written twice.
+_open_writers: 'weakref.WeakSet[RecordWriter]' = weakref.WeakSet()
+_previous_sigterm_handler = None
+_sigterm_handler_installed = False
+
+
+def _install_sigterm_handler():
+    global _previous_sigterm_handler, _sigterm_handler_installed
+    # Signal handlers can only be installed from the main thread.
+    if _sigterm_handler_installed or threading.current_thread() is not threading.main_thread():
+        return
+    _previous_sigterm_handler = signal.signal(signal.SIGTERM, _flush_on_sigterm)
+    _sigterm_handler_installed = True
+
+
+def _flush_on_sigterm(signum, frame):
+    global _sigterm_handler_installed
+    for writer in list(_open_writers):
+        writer._flush_on_signal()
+    previous = _previous_sigterm_handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL if previous is None else previous)
+    _sigterm_handler_installed = False
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        os.kill(os.getpid(), signum)
+
+
+class FileLock:
+    """Holds an exclusive advisory lock on an open file, when the platform supports it."""
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from record_writer import RecordWriter
+
+
+def test_header_only_written_once():
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        with RecordWriter(f, header="a,b", echo=False) as writer:
+            writer.write("1,2")
+        with RecordWriter(f, header="a,b", echo=False) as writer:
+            writer.write("3,4")
+        with open(f) as file:
+            assert file.read() == "a,b\n1,2\n3,4\n"
+
+        with RecordWriter(f, header="a,b", discard_previous_data=True, echo=False):
+            pass
+        with open(f) as file:
+            assert file.read() == "a,b\n"
+
+
+def test_buffers_until_threshold():
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        writer = RecordWriter(f, echo=False, max_buffered_records=3, max_buffer_seconds=1000)
+        writer.write("1")
+        writer.write("2")
+        with open(f) as file:
+            assert file.read() == ""
+        writer.write("3")
+        with open(f) as file:
+            assert file.read() == "1\n2\n3\n"
+
+        writer.write("4")
+        writer.close()
+        with open(f) as file:
+            assert file.read() == "1\n2\n3\n4\n"
+
+
+def test_flushes_after_delay():
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        with RecordWriter(f, echo=False, max_buffered_records=1000, max_buffer_seconds=0.01) as writer:
+            writer.write("1")
+            time.sleep(1)
+            with open(f) as file:
+                assert file.read() == "1\n"
+
+
+def _write_many(path: str, k: int):
+    with RecordWriter(path, header="header", echo=False, max_buffered_records=7) as writer:
+        for i in range(500):
+            writer.write(f"{k}," + "x" * 500 + f",{i}")
+
+
+def test_concurrent_writers_dont_interleave_lines():
+    with tempfile.TemporaryDirectory() as d:
+        f = d + "/tmp.csv"
+        processes = [multiprocessing.Process(target=_write_many, args=(f, k)) for k in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        with open(f) as file:
+            lines = file.read().splitlines()
+    assert lines[0] == "header"
+    assert len(lines) == 1 + 4 * 500
+    for k in range(4):
+        assert [line for line in lines[1:] if line.startswith(f"{k},")] == [
+            f"{k}," + "x" * 500 + f",{i}" for i in range(500)
+        ]
+
+
+def test_flushes_when_terminated(tmp_path):
+    f = str(tmp_path / "tmp.csv")
+    process = subprocess.Popen([sys.executable, "-c", f"""
+import time
+from record_writer import RecordWriter
+writer = RecordWriter({f!r}, header="a,b", echo=False, max_buffered_records=1000, max_buffer_seconds=1000)
+writer.write("1,2")
+writer.write("3,4")
+print("ready", flush=True)
+time.sleep(60)
+"""], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE)
+    try:
+        assert process.stdout.readline() == b"ready\n"
+        with open(f) as file:
+            assert file.read() == "a,b\n"
+        process.send_signal(signal.SIGTERM)
+        # The signal still terminates the process, after the lines are written.
+        assert process.wait(timeout=30) == -signal.SIGTERM
+    finally:
+        process.kill()
+        process.stdout.close()
+    with open(f) as file:
+        assert file.read() == "a,b\n1,2\n3,4\n"
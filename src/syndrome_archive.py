@@ -0,0 +1,112 @@
+"""This file contains an on-disk archive of sampled detection events, for decoding them again later."""
+
+import json
+import os
+import pathlib
+from typing import Any, Dict, Iterator, Tuple
+
+import numpy as np
+import stim
+
+from record_writer import FileLock
+
+
+class SyndromeArchive:
+    """A directory of bit packed samples taken from one circuit.
+
+    The directory contains:
+        circuit.stim: The circuit the samples were taken from.
+        metadata.json: The detector and observable counts, and caller provided identifying data.
+        shots.b8: One fixed size row per shot. Each row is the shot's detection events bit packed
+            into (num_detectors + 7) // 8 bytes, followed by its observable flips bit packed into
+            (num_observables + 7) // 8 bytes. Bits are packed in little endian order.
+
+    Samples are appended while holding an exclusive lock on the shots file, so several processes
+    can add to the same archive. The number of shots is implied by the size of the shots file.
+    """
+
+    def __init__(self, path: str):
+        """Opens an existing archive. Use `SyndromeArchive.create` to make a new one."""
+        self.path = pathlib.Path(path)
+        with open(self.path / "metadata.json") as f:
+            self.metadata: Dict[str, Any] = json.load(f)
+        self.num_detectors: int = self.metadata["num_detectors"]
+        self.num_observables: int = self.metadata["num_observables"]
+        self.det_bytes_per_shot = (self.num_detectors + 7) // 8
+        self.bytes_per_shot = self.det_bytes_per_shot + (self.num_observables + 7) // 8
+
+    @staticmethod
+    def create(path: str, *, circuit: stim.Circuit, metadata: Dict[str, Any]) -> 'SyndromeArchive':
+        """Opens the archive at `path`, creating it if it doesn't exist yet.
+
+        Args:
+            path: The archive's directory.
+            circuit: The circuit that samples will be taken from.
+            metadata: JSON serializable data identifying the sampled problem.
+
+        Raises:
+            ValueError: The archive already exists, but was made for a different circuit.
+        """
+        p = pathlib.Path(path)
+        if not (p / "metadata.json").exists():
+            p.mkdir(parents=True, exist_ok=True)
+            _write_atomically(p / "circuit.stim", str(circuit))
+            _write_atomically(p / "metadata.json", json.dumps({
+                **metadata,
+                "num_detectors": circuit.num_detectors,
+                "num_observables": circuit.num_observables,
+            }, indent=2))
+        result = SyndromeArchive(path)
+        if result.circuit != circuit:
+            raise ValueError(f"The archive at {path} was made for a different circuit.")
+        return result
+
+    @property
+    def circuit(self) -> stim.Circuit:
+        return stim.Circuit((self.path / "circuit.stim").read_text())
+
+    @property
+    def num_shots(self) -> int:
+        shots_path = self.path / "shots.b8"
+        if not shots_path.exists():
+            return 0
+        return os.path.getsize(shots_path) // self.bytes_per_shot
+
+    def append(self, det_samples: np.ndarray, obs_samples: np.ndarray):
+        """Adds bit packed samples to the archive.
+
+        Args:
+            det_samples: A uint8 array with one row of bit packed detection events per shot.
+            obs_samples: A uint8 array with one row of bit packed observable flips per shot.
+        """
+        assert det_samples.shape[1] == self.det_bytes_per_shot
+        assert obs_samples.shape[1] == self.bytes_per_shot - self.det_bytes_per_shot
+        data = np.concatenate([det_samples, obs_samples], axis=1).astype(np.uint8).tobytes()
+        fd = os.open(self.path / "shots.b8", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            with FileLock(fd):
+                while data:
+                    data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yields the archived samples as (det_samples, obs_samples) pairs of at most `chunk_size` shots.
+
+        Only one chunk is held in memory at a time.
+        """
+        num_shots = self.num_shots
+        if num_shots == 0:
+            return
+        with open(self.path / "shots.b8", "rb") as f:
+            for start in range(0, num_shots, chunk_size):
+                n = min(chunk_size, num_shots - start)
+                rows = np.fromfile(f, dtype=np.uint8, count=n * self.bytes_per_shot)
+                rows = rows.reshape((n, self.bytes_per_shot))
+                yield rows[:, :self.det_bytes_per_shot], rows[:, self.det_bytes_per_shot:]
+
+
+def _write_atomically(path: pathlib.Path, text: str):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,35 @@
+import tempfile
+
+import numpy as np
+import pytest
+import stim
+
+from syndrome_archive import SyndromeArchive
+
+
+def test_append_and_iter_chunks():
+    circuit = stim.Circuit.generated("repetition_code:memory", distance=5, rounds=3, before_round_data_depolarization=0.1)
+    sampler = circuit.compile_detector_sampler(seed=1)
+    with tempfile.TemporaryDirectory() as d:
+        archive = SyndromeArchive.create(d + "/a", circuit=circuit, metadata={"name": "rep"})
+        assert archive.num_shots == 0
+        assert list(archive.iter_chunks(10)) == []
+
+        dets1, obs1 = sampler.sample(7, separate_observables=True, bit_packed=True)
+        dets2, obs2 = sampler.sample(5, separate_observables=True, bit_packed=True)
+        archive.append(dets1, obs1)
+        archive.append(dets2, obs2)
+
+        reopened = SyndromeArchive(d + "/a")
+        assert reopened.num_shots == 12
+        assert reopened.metadata["name"] == "rep"
+        assert reopened.circuit == circuit
+        chunks = list(reopened.iter_chunks(5))
+        assert [c[0].shape[0] for c in chunks] == [5, 5, 2]
+        np.testing.assert_array_equal(np.concatenate([c[0] for c in chunks]), np.concatenate([dets1, dets2]))
+        np.testing.assert_array_equal(np.concatenate([c[1] for c in chunks]), np.concatenate([obs1, obs2]))
+
+        # Reopening for the same circuit keeps the samples. A different circuit is refused.
+        assert SyndromeArchive.create(d + "/a", circuit=circuit, metadata={"name": "rep"}).num_shots == 12
+        with pytest.raises(ValueError):
+            SyndromeArchive.create(d + "/a", circuit=circuit * 2, metadata={"name": "rep"})
@@ -0,0 +1,103 @@
+import numpy as np
+import stim
+
+from decoding import DecodingArtifacts, decode_using_pymatching, sample_decode_count_correct
+from honeycomb_circuit import generate_honeycomb_circuit
+from honeycomb_layout import HoneycombLayout
+from union_find_decoding import UnionFindDecoder
+
+
+def test_union_find_decoder_corrects_single_errors():
+    # A line of 5 detectors, with boundaries at both ends. The left boundary edge flips observable 0.
+    #   B -0- D0 --- D1 --- D2 --- D3 --- D4 --- B
+    decoder = UnionFindDecoder(
+        nodes1=np.array([0, 0, 1, 2, 3, 4]),
+        nodes2=np.array([5, 1, 2, 3, 4, 5]),
+        weights=np.ones(6),
+        observable_masks=np.array([1, 0, 0, 0, 0, 0]),
+        num_detectors=5,
+        num_observables=1,
+    )
+    dets = np.array([
+        [0, 0, 0, 0, 0],
+        [1, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0],
+        [0, 1, 1, 0, 0],
+        [0, 0, 0, 0, 1],
+        [0, 1, 0, 0, 0],
+        [0, 0, 0, 1, 0],
+        [1, 0, 0, 0, 1],
+    ], dtype=np.bool_)
+    np.testing.assert_array_equal(decoder.decode(dets)[:, 0], [0, 1, 0, 0, 0, 1, 0, 1])
+
+
+def test_union_find_decoder_is_close_to_matching():
+    circuit = stim.Circuit.generated(
+        "surface_code:rotated_memory_x",
+        distance=5,
+        rounds=5,
+        after_clifford_depolarization=0.005,
+        before_measure_flip_probability=0.005,
+        after_reset_flip_probability=0.005,
+    )
+    artifacts = DecodingArtifacts(circuit=circuit)
+    dets, obs = circuit.compile_detector_sampler(seed=3).sample(3000, separate_observables=True)
+    uf_errors = np.count_nonzero(np.any(artifacts.union_find_decoder.decode(dets) != obs, axis=1))
+    pm_errors = np.count_nonzero(np.any(decode_using_pymatching(circuit, dets, False, artifacts) != obs, axis=1))
+    assert pm_errors <= uf_errors < pm_errors * 1.5 + 10
+
+
+def test_union_find_decoder_bit_packed():
+    circuit = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=20,
+        noise=0.01,
+        style="SD6",
+        obs="V",
+    ))
+    artifacts = DecodingArtifacts(circuit=circuit)
+    dets = circuit.compile_detector_sampler(seed=4).sample(500)
+    unpacked = artifacts.union_find_decoder.decode(dets)
+    packed = artifacts.union_find_decoder.decode(np.packbits(dets, axis=1, bitorder='little'), bit_packed=True)
+    np.testing.assert_array_equal(packed, np.packbits(unpacked, axis=1, bitorder='little'))
+
+
+def test_union_find_decoder_runs_by_name():
+    circuit = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=20,
+        noise=0.001,
+        style="PC3",
+        obs="V",
+    ))
+    num_correct = sample_decode_count_correct(circuit=circuit, num_shots=2000, decoder="union_find", seed=1)
+    expected = sample_decode_count_correct(circuit=circuit, num_shots=2000, decoder="pymatching", seed=1)
+    assert expected * 0.95 <= num_correct <= 2000
+
+
+def test_union_find_decoder_sub_batches_match_whole_batch():
+    circuit = stim.Circuit.generated(
+        "surface_code:rotated_memory_x",
+        distance=3,
+        rounds=3,
+        after_clifford_depolarization=0.01,
+    )
+    artifacts = DecodingArtifacts(circuit=circuit)
+    edges = artifacts.union_find_decoder
+    kwargs = dict(
+        nodes1=edges.nodes1,
+        nodes2=edges.nodes2,
+        weights=np.ones(len(edges.nodes1)),
+        observable_masks=edges.observable_masks,
+        num_detectors=edges.num_detectors,
+        num_observables=edges.num_observables,
+    )
+    split = UnionFindDecoder(**kwargs, max_batch_edges=len(edges.nodes1) * 7)
+    assert split.max_batch_shots == 7
+    dets = circuit.compile_detector_sampler(seed=2).sample(300, bit_packed=True)
+    np.testing.assert_array_equal(
+        split.decode(dets, bit_packed=True),
+        UnionFindDecoder(**kwargs).decode(dets, bit_packed=True),
+    )
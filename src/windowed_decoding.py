@@ -0,0 +1,223 @@
+"""This file contains a decoder that matches overlapping time windows of a long experiment one at a time."""
+
+import collections
+import dataclasses
+import hashlib
+from typing import Callable, List
+
+import numpy as np
+import pymatching
+
+
+@dataclasses.dataclass
+class DecodingWindow:
+    """The part of the decoding graph that is matched while decoding one window.
+
+    Attributes:
+        detectors: The detectors inside the window, sorted. Local node k is `detectors[k]`, and
+            local node `len(detectors)` is the boundary (which also stands in for the detectors
+            after the window).
+        edges: The edge (index into the decoder's edge arrays) of each local edge.
+        nodes1: The first local node of each local edge.
+        nodes2: The second local node of each local edge.
+        committed: Whether each local edge is committed when it's part of the window's matching.
+        key: Identifies the window's local graph, so that windows with the same shape (e.g. in the
+            repeating middle part of a memory experiment) share a matching graph.
+    """
+    detectors: np.ndarray
+    edges: np.ndarray
+    nodes1: np.ndarray
+    nodes2: np.ndarray
+    committed: np.ndarray
+    key: bytes
+
+
+class WindowedDecoder:
+    """Decodes shots by matching overlapping time windows of the decoding graph, from first to last.
+
+    Each window covers the detectors whose time is in `[start, start + commit_size + buffer_size)`.
+    Its graph has the edges whose earliest detector is in the window. Edges that reach past the
+    end of the window lead to the boundary instead, and edges that reach back before its start are
+    left out, because everything before the window has already been decided. After matching a
+    window, the matched edges that start in its first `commit_size` of time (all of them, in the
+    last window) are committed: their observable flips are added to the prediction, and the
+    detection events at their ends are flipped, which clears the committed part of the window and
+    carries the rest forward. The next window starts `commit_size` later.
+
+    Only a few windows' matching graphs are kept at a time, so the memory used by pymatching
+    depends on the window size instead of the length of the experiment. Windows with the same
+    local graph share a matching graph. With a buffer that is a few times the code distance long,
+    errors near the commit boundary are decided with enough context that the logical error rate
+    matches that of matching the whole graph at once.
+    """
+
+    def __init__(self,
+                 *,
+                 nodes1: np.ndarray,
+                 nodes2: np.ndarray,
+                 weights: np.ndarray,
+                 observable_masks: np.ndarray,
+                 detector_times: np.ndarray,
+                 num_detectors: int,
+                 num_observables: int,
+                 build_matching: Callable[..., pymatching.Matching],
+                 commit_size: float,
+                 buffer_size: float,
+                 max_cached_windows: int = 4):
+        """
+        Args:
+            nodes1: The first node of each edge.
+            nodes2: The second node of each edge. Node `num_detectors` is the boundary.
+            weights: The weight of each edge.
+            observable_masks: The observables flipped by each edge, as bit masks.
+            detector_times: The time coordinate of each detector.
+            num_detectors: The number of detectors.
+            num_observables: The number of observables.
+            build_matching: Builds a window's matching graph, given keyword arguments `nodes1`,
+                `nodes2`, `weights`, `fault_ids` and `num_detectors` (e.g.
+                `decoding.pymatching_graph_from_edges`). Local edge k is given fault id k.
+            commit_size: How far forward in time each window moves.
+            buffer_size: How far past the committed part each window extends.
+            max_cached_windows: The number of distinct window matching graphs to keep.
+
+        The edges can be made by `decoding.detector_error_model_to_edge_arrays`.
+        """
+        assert num_observables <= 64
+        assert commit_size > 0 and buffer_size >= 0
+        assert len(detector_times) == num_detectors
+        self.num_detectors = num_detectors
+        self.num_observables = num_observables
+        self.nodes1 = np.asarray(nodes1, dtype=np.int64)
+        self.nodes2 = np.asarray(nodes2, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.observable_masks = np.asarray(observable_masks, dtype=np.uint64)
+        self.detector_times = np.asarray(detector_times, dtype=np.float64)
+        self.commit_size = commit_size
+        self.buffer_size = buffer_size
+        self.max_cached_windows = max_cached_windows
+        self.num_matching_graphs_built = 0
+        self._build_matching = build_matching
+        self._matchings: collections.OrderedDict[bytes, pymatching.Matching] = collections.OrderedDict()
+        self.windows = self._make_windows()
+
+    def _make_windows(self) -> List[DecodingWindow]:
+        num_detectors = self.num_detectors
+        # The boundary is later than every detector.
+        times = np.append(self.detector_times, np.inf)
+        edge_starts = np.minimum(times[self.nodes1], times[self.nodes2])
+        edge_order = np.argsort(edge_starts, kind='stable')
+        sorted_edge_starts = edge_starts[edge_order]
+        det_order = np.argsort(self.detector_times, kind='stable')
+        sorted_det_times = self.detector_times[det_order]
+
+        windows = []
+        if num_detectors == 0:
+            return windows
+        last_time = sorted_det_times[-1]
+        start = sorted_det_times[0]
+        while True:
+            end = start + self.commit_size + self.buffer_size
+            is_last = end > last_time
+            commit_end = np.inf if is_last else start + self.commit_size
+
+            d0, d1 = np.searchsorted(sorted_det_times, [start, end])
+            detectors = np.sort(det_order[d0:d1])
+            e0, e1 = np.searchsorted(sorted_edge_starts, [start, end])
+            edges = np.sort(edge_order[e0:e1])
+
+            # Endpoints outside the window (later detectors, or the boundary) become the boundary.
+            boundary = len(detectors)
+            local = []
+            for nodes in [self.nodes1[edges], self.nodes2[edges]]:
+                local.append(np.where(np.isin(nodes, detectors), np.searchsorted(detectors, nodes), boundary))
+            nodes1 = np.minimum(*local)
+            nodes2 = np.maximum(*local)
+
+            # Edges that became parallel are merged, keeping the lightest.
+            order = np.lexsort((self.weights[edges], nodes2, nodes1))
+            edges, nodes1, nodes2 = edges[order], nodes1[order], nodes2[order]
+            first = np.ones(len(edges), dtype=np.bool_)
+            first[1:] = (nodes1[1:] != nodes1[:-1]) | (nodes2[1:] != nodes2[:-1])
+            edges, nodes1, nodes2 = edges[first], nodes1[first], nodes2[first]
+
+            key = hashlib.sha256(b"".join([
+                np.int64(boundary).tobytes(),
+                nodes1.tobytes(),
+                nodes2.tobytes(),
+                self.weights[edges].tobytes(),
+            ])).digest()
+            windows.append(DecodingWindow(
+                detectors=detectors,
+                edges=edges,
+                nodes1=nodes1,
+                nodes2=nodes2,
+                committed=edge_starts[edges] < commit_end,
+                key=key,
+            ))
+            if is_last:
+                return windows
+            start += self.commit_size
+
+    def _matching(self, window: DecodingWindow) -> pymatching.Matching:
+        matching = self._matchings.get(window.key)
+        if matching is None:
+            matching = self._build_matching(
+                nodes1=window.nodes1,
+                nodes2=window.nodes2,
+                weights=self.weights[window.edges],
+                fault_ids=[{k} for k in range(len(window.edges))],
+                num_detectors=len(window.detectors),
+            )
+            self.num_matching_graphs_built += 1
+            self._matchings[window.key] = matching
+            while len(self._matchings) > self.max_cached_windows:
+                self._matchings.popitem(last=False)
+        else:
+            self._matchings.move_to_end(window.key)
+        return matching
+
+    def decode(self, det_samples: np.ndarray, *, bit_packed: bool = False) -> np.ndarray:
+        """Predicts the observable flips of a batch of shots.
+
+        Args:
+            det_samples: The detection events, with one row per shot.
+            bit_packed: Whether the detection events are bit packed (little endian) along each row.
+                If set, the predictions are also returned bit packed.
+
+        Returns:
+            The predicted observable flips, with one row per shot.
+        """
+        num_shots = det_samples.shape[0]
+        if bit_packed:
+            events = np.unpackbits(det_samples, axis=1, count=self.num_detectors, bitorder='little')
+        else:
+            events = np.array(det_samples, dtype=np.uint8)
+        # The boundary column absorbs the flips of edges that end at the boundary.
+        events = np.concatenate([events, np.zeros((num_shots, 1), dtype=np.uint8)], axis=1)
+
+        masks = np.zeros(num_shots, dtype=np.uint64)
+        for window in self.windows:
+            if len(window.edges) == 0:
+                continue
+            window_events = events[:, window.detectors]
+            shots = np.flatnonzero(np.any(window_events, axis=1))
+            if len(shots) == 0:
+                continue
+            matching = self._matching(window)
+            syndrome = np.zeros(matching.num_detectors, dtype=np.uint8)
+            committed_edges = window.edges[window.committed]
+            for shot in shots.tolist():
+                syndrome[:len(window.detectors)] = window_events[shot]
+                used = np.asarray(matching.decode(syndrome), dtype=np.bool_)[:len(window.edges)]
+                edges = committed_edges[used[window.committed]]
+                if len(edges) == 0:
+                    continue
+                masks[shot] ^= np.bitwise_xor.reduce(self.observable_masks[edges])
+                np.bitwise_xor.at(events[shot], self.nodes1[edges], 1)
+                np.bitwise_xor.at(events[shot], self.nodes2[edges], 1)
+
+        num_bytes = (self.num_observables + 7) // 8
+        packed = masks.astype('<u8').view(np.uint8).reshape((num_shots, 8))[:, :num_bytes]
+        if bit_packed:
+            return np.ascontiguousarray(packed)
+        return np.unpackbits(packed, axis=1, count=self.num_observables, bitorder='little').astype(np.bool_)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import stim
+
+from decoding import DecodingArtifacts, decode_using_pymatching, detector_error_model_to_edge_arrays, \
+    detector_time_coordinates, pymatching_graph_from_edges, sample_decode_count_correct
+from honeycomb_circuit import generate_honeycomb_circuit
+from honeycomb_layout import HoneycombLayout
+from windowed_decoding import WindowedDecoder
+
+
+def _windowed_decoder(model: stim.DetectorErrorModel, *, commit_size: float, buffer_size: float) -> WindowedDecoder:
+    nodes1, nodes2, probabilities, masks = detector_error_model_to_edge_arrays(model)
+    return WindowedDecoder(
+        nodes1=nodes1,
+        nodes2=nodes2,
+        weights=np.log((1 - probabilities) / probabilities),
+        observable_masks=masks,
+        detector_times=detector_time_coordinates(model),
+        num_detectors=model.num_detectors,
+        num_observables=model.num_observables,
+        build_matching=pymatching_graph_from_edges,
+        commit_size=commit_size,
+        buffer_size=buffer_size,
+    )
+
+
+def test_windowed_decoder_corrects_single_errors():
+    circuit = stim.Circuit.generated(
+        "repetition_code:memory",
+        distance=5,
+        rounds=20,
+        before_round_data_depolarization=0.01,
+        before_measure_flip_probability=0.01,
+    )
+    model = circuit.detector_error_model(decompose_errors=True)
+    decoder = _windowed_decoder(model, commit_size=3, buffer_size=4)
+    assert len(decoder.windows) > 3
+
+    # Every single error is detected and corrected, wherever it is relative to the windows.
+    nodes1, nodes2, _, masks = detector_error_model_to_edge_arrays(model)
+    dets = np.zeros((len(nodes1), model.num_detectors + 1), dtype=np.bool_)
+    dets[np.arange(len(nodes1)), nodes1] = True
+    dets[np.arange(len(nodes1)), nodes2] = True
+    predictions = decoder.decode(dets[:, :-1])
+    np.testing.assert_array_equal(predictions[:, 0], masks == 1)
+
+
+def test_windowed_decoder_is_close_to_full_matching():
+    circuit = stim.Circuit.generated(
+        "surface_code:rotated_memory_x",
+        distance=3,
+        rounds=40,
+        after_clifford_depolarization=0.004,
+        before_measure_flip_probability=0.004,
+    )
+    model = circuit.detector_error_model(decompose_errors=True)
+    decoder = _windowed_decoder(model, commit_size=5, buffer_size=5)
+    dets, obs = circuit.compile_detector_sampler(seed=7).sample(2000, separate_observables=True)
+    windowed_errors = np.count_nonzero(np.any(decoder.decode(dets) != obs, axis=1))
+    full_errors = np.count_nonzero(np.any(decode_using_pymatching(circuit, dets, False) != obs, axis=1))
+    assert abs(windowed_errors - full_errors) <= full_errors * 0.1 + 10
+
+    # Windows in the repeating middle of the experiment share their matching graph.
+    assert decoder.num_matching_graphs_built < len(decoder.windows)
+
+
+def test_windowed_decoder_runs_by_name():
+    circuit = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=60,
+        noise=0.001,
+        style="PC3",
+        obs="V",
+    ))
+    artifacts = DecodingArtifacts(circuit=circuit, decoding_window=(12, 12))
+    num_correct = sample_decode_count_correct(artifacts=artifacts, num_shots=1000, decoder="pymatching_windowed", seed=3)
+    expected = sample_decode_count_correct(artifacts=artifacts, num_shots=1000, decoder="pymatching", seed=3)
+    assert abs(num_correct - expected) <= 20
+    # The detectors' times run from 1 to 60, so the windows start at 1, 13, 25, and 37.
+    assert len(artifacts.windowed_decoder.windows) == 4
+
+
+def test_detector_time_coordinates():
+    circuit = generate_honeycomb_circuit(HoneycombLayout(
+        data_width=2,
+        data_height=6,
+        sub_rounds=20,
+        noise=0.001,
+        style="PC3",
+        obs="V",
+    ))
+    times = detector_time_coordinates(circuit.detector_error_model(decompose_errors=True))
+    assert len(times) == circuit.num_detectors
+    assert np.all(np.diff(times) >= 0)
+    assert times[-1] == 20
+
+    with pytest.raises(ValueError, match="coordinates"):
+        detector_time_coordinates(stim.DetectorErrorModel("error(0.1) D0 D1"))